@@ -1,5 +1,11 @@
-from datetime import datetime
+from contextlib import contextmanager
+import copy
+from datetime import datetime, timezone
 import os
+import threading
+import time
+
+from sqlalchemy.orm import scoped_session, sessionmaker
 
 from qwc_config_db.config_models import ConfigModels
 from qwc_services_core.database import DatabaseEngine
@@ -23,6 +29,14 @@ class ConfigService:
         self.logger = logger
         self.db_engine = DatabaseEngine()
         self.config_models = ConfigModels(self.db_engine)
+        # resolve ORM model once
+        self.LastUpdate = self.config_models.model('last_update')
+        # process-wide session factory for ConfigDB
+        # NOTE: reuses pooled connections instead of creating a new
+        #       session per request
+        self.db_session = scoped_session(
+            sessionmaker(bind=self.db_engine.config_db())
+        )
         default_allow = os.environ.get(
             'DEFAULT_ALLOW', 'True') == 'True'
         data_permission_handler = DataServicePermission(
@@ -47,47 +61,101 @@ class ConfigService:
             self.config_models, logger
         )
 
+        # in-process cache for permission query results:
+        #     {<cache key>: (<expiry time>, <result>)}
+        # set CONFIG_PERMISSIONS_CACHE_TTL=0 to disable
+        self.result_cache = {}
+        self.result_cache_lock = threading.RLock()
+        self.result_cache_ttl = int(os.environ.get(
+            'CONFIG_PERMISSIONS_CACHE_TTL', '60'
+        ))
+
         # get path to QWC2 themes config from ENV
         qwc2_path = os.environ.get('QWC2_PATH', 'qwc2/')
         self.themes_config_path = os.environ.get(
             'QWC2_THEMES_CONFIG', os.path.join(qwc2_path, 'themesConfig.json')
         )
 
-        if os.environ.get("__QWC_CONFIG_SERVICE_PROJECT_SETTINGS_STARTUP_CACHE", "0") == "1":
-            self.cache_project_settings()
+        # short-lived cache for themes config mtime:
+        #     (<checked at>, <config updated at>)
+        self.themes_mtime_cache = (0, None)
+
+        # cache for formatted last update timestamp:
+        #     (<updated at>, <formatted timestamp>)
+        self.last_update_cache = (None, None)
+
+        # prewarm caches in a background thread on startup and on
+        # permission updates, so cold-cache latency stays off requests
+        self.prewarm_enabled = os.environ.get(
+            "__QWC_CONFIG_SERVICE_PROJECT_SETTINGS_STARTUP_CACHE", "0"
+        ) == "1"
+        self.prewarm_lock = threading.Lock()
+        self.prewarm_thread = None
+        if self.prewarm_enabled:
+            self.start_prewarm()
+
+    @contextmanager
+    def session_scope(self):
+        """Provide a scoped session for ConfigDB queries."""
+        try:
+            yield self.db_session()
+        finally:
+            self.db_session.remove()
+
+    def themes_config_updated_at(self):
+        """Return modification time of QWC2 themes config file.
+
+        The mtime is cached for one second, as last_update() is polled
+        frequently and also versions the permission result cache.
+        """
+        checked_at, config_updated_at = self.themes_mtime_cache
+        now = time.monotonic()
+        if now - checked_at < 1.0:
+            return config_updated_at
+
+        config_updated_at = None
+        if os.path.isfile(self.themes_config_path):
+            # NOTE: keep timestamp naive for comparison with ConfigDB
+            config_updated_at = datetime.fromtimestamp(
+                os.path.getmtime(self.themes_config_path), timezone.utc
+            ).replace(tzinfo=None)
+        self.themes_mtime_cache = (now, config_updated_at)
+
+        return config_updated_at
 
     def last_update(self):
         """Return UTC timestamp of last permissions update."""
         # get modification time of QWC2 themes config file
-        config_updated_at = None
-        if os.path.isfile(self.themes_config_path):
-            config_updated_at = datetime.utcfromtimestamp(
-                os.path.getmtime(self.themes_config_path)
-            )
+        config_updated_at = self.themes_config_updated_at()
 
-        # create session for ConfigDB
-        session = self.config_models.session()
-
-        # query timestamp
-        LastUpdate = self.config_models.model('last_update')
-        query = session.query(LastUpdate.updated_at)
-        last_update = query.first()
-        if last_update is not None:
-            if config_updated_at is not None:
-                # use latest of both timestamps
-                updated_at = max(last_update.updated_at, config_updated_at)
+        with self.session_scope() as session:
+            # query timestamp
+            # NOTE: use scalar value to avoid ORM row hydration
+            LastUpdate = self.LastUpdate
+            last_updated_at = session.query(LastUpdate.updated_at).scalar()
+            if last_updated_at is not None:
+                if config_updated_at is not None:
+                    # use latest of both timestamps
+                    updated_at = max(last_updated_at, config_updated_at)
+                else:
+                    # use timestamp from ConfigDB
+                    updated_at = last_updated_at
             else:
-                # use timestamp from ConfigDB
-                updated_at = last_update.updated_at
-        else:
-            # no entry in ConfigDB, use config timestamp or now
-            updated_at = config_updated_at or datetime.utcnow()
+                # no entry in ConfigDB, use config timestamp or now
+                updated_at = config_updated_at or \
+                    datetime.now(timezone.utc).replace(tzinfo=None)
 
-        # close session
-        session.close()
+        # only reformat timestamp when it has changed
+        if self.last_update_cache[0] != updated_at:
+            self.last_update_cache = (
+                updated_at, updated_at.strftime("%Y-%m-%d %H:%M:%S")
+            )
+            if self.prewarm_enabled:
+                # permissions have changed, re-prewarm caches
+                self.start_prewarm()
 
         return {
-            'permissions_updated_at': updated_at.strftime("%Y-%m-%d %H:%M:%S")
+            'permissions_updated_at': self.last_update_cache[1]
         }
 
     def service_permissions(self, service, params, username, group):
@@ -100,22 +168,37 @@ class ConfigService:
         """
         permission_handler = self.permission_handlers.get(service, None)
         if permission_handler is not None:
-            # create session for ConfigDB
-            session = self.config_models.session()
+            cache_key = (
+                'service_permissions', service,
+                tuple(sorted(params.items())), username, group
+            )
+            return self.cached_result(
+                cache_key,
+                lambda: self.query_service_permissions(
+                    permission_handler, params, username, group
+                )
+            )
+        else:
+            return {'error': "Service type '%s' not found" % service}
+
+    def query_service_permissions(self, permission_handler, params, username,
+                                  group):
+        """Query permissions for a service from ConfigDB.
 
+        :param PermissionQuery permission_handler: Service permission handler
+        :param obj params: Service specific request parameters
+        :param str username: User name
+        :param str group: Group name
+        """
+        with self.session_scope() as session:
             # query permissions
             permissions = permission_handler.permissions(
                 params, username, group, session
             )
 
-            # close session
-            session.close()
-
-            return {
-                'permissions': permissions
-            }
-        else:
-            return {'error': "Service type '%s' not found" % service}
+        return {
+            'permissions': permissions
+        }
 
     def resource_permissions(self, resource_type, params, username, group):
         """Return permitted resources for a resource type.
@@ -125,16 +208,31 @@ class ConfigService:
         :param str username: User name
         :param str group: Group name
         """
-        # create session for ConfigDB
-        session = self.config_models.session()
-
-        # query permitted resources
-        permissions = self.resource_permission_handler.permissions(
-            resource_type, params, username, group, session
+        cache_key = (
+            'resource_permissions', resource_type,
+            tuple(sorted(params.items())), username, group
+        )
+        return self.cached_result(
+            cache_key,
+            lambda: self.query_resource_permissions(
+                resource_type, params, username, group
+            )
         )
 
-        # close session
-        session.close()
+    def query_resource_permissions(self, resource_type, params, username,
+                                   group):
+        """Query permitted resources for a resource type from ConfigDB.
+
+        :param str resource_type: Resource type
+        :param obj params: Request parameters
+        :param str username: User name
+        :param str group: Group name
+        """
+        with self.session_scope() as session:
+            # query permitted resources
+            permissions = self.resource_permission_handler.permissions(
+                resource_type, params, username, group, session
+            )
 
         return {
             'permissions': permissions
@@ -148,20 +246,138 @@ class ConfigService:
         :param str username: User name
         :param str group: Group name
         """
-        # create session for ConfigDB
-        session = self.config_models.session()
-
-        # query restricted resources
-        restrictions = self.resource_permission_handler.restrictions(
-            resource_type, params, username, group, session
+        cache_key = (
+            'resource_restrictions', resource_type,
+            tuple(sorted(params.items())), username, group
+        )
+        return self.cached_result(
+            cache_key,
+            lambda: self.query_resource_restrictions(
+                resource_type, params, username, group
+            )
         )
 
-        # close session
-        session.close()
+    def query_resource_restrictions(self, resource_type, params, username,
+                                    group):
+        """Query restricted resources for a resource type from ConfigDB.
+
+        :param str resource_type: Resource type
+        :param obj params: Request parameters
+        :param str username: User name
+        :param str group: Group name
+        """
+        with self.session_scope() as session:
+            # query restricted resources
+            restrictions = self.resource_permission_handler.restrictions(
+                resource_type, params, username, group, session
+            )
 
         return {
             'restrictions': restrictions
         }
 
+    def resource_permissions_and_restrictions(self, resource_type, params,
+                                              username, group):
+        """Return permitted and restricted resources for a resource type.
+
+        :param str resource_type: Resource type
+        :param obj params: Request parameters
+        :param str username: User name
+        :param str group: Group name
+        """
+        cache_key = (
+            'resource_permissions_and_restrictions', resource_type,
+            tuple(sorted(params.items())), username, group
+        )
+        return self.cached_result(
+            cache_key,
+            lambda: self.query_resource_permissions_and_restrictions(
+                resource_type, params, username, group
+            )
+        )
+
+    def query_resource_permissions_and_restrictions(self, resource_type,
+                                                    params, username, group):
+        """Query permitted and restricted resources for a resource type
+        from ConfigDB in a single transaction.
+
+        :param str resource_type: Resource type
+        :param obj params: Request parameters
+        :param str username: User name
+        :param str group: Group name
+        """
+        with self.session_scope() as session:
+            # query permitted and restricted resources
+            return self.resource_permission_handler. \
+                permissions_and_restrictions(
+                    resource_type, params, username, group, session
+                )
+
+    def cached_result(self, cache_key, query):
+        """Return cached query result, or compute and cache it.
+
+        Results are kept for CONFIG_PERMISSIONS_CACHE_TTL seconds and
+        invalidated when the permissions timestamp changes.
+
+        :param tuple cache_key: Cache key for request
+        :param function query: Function for querying the result
+        """
+        if self.result_cache_ttl <= 0:
+            # caching disabled
+            return query()
+
+        # include permissions timestamp so updates invalidate the cache
+        version = self.last_update()['permissions_updated_at']
+        key = cache_key + (version,)
+
+        now = time.monotonic()
+        with self.result_cache_lock:
+            entry = self.result_cache.get(key)
+            if entry is not None and entry[0] > now:
+                # return copy of cached result
+                return copy.deepcopy(entry[1])
+
+        result = query()
+
+        with self.result_cache_lock:
+            if len(self.result_cache) >= 10000:
+                # limit cache size
+                self.result_cache.clear()
+            self.result_cache[key] = (
+                now + self.result_cache_ttl, copy.deepcopy(result)
+            )
+
+        return result
+
+    def start_prewarm(self):
+        """Start prewarming caches in a background thread, unless a
+        prewarm is already running.
+        """
+        with self.prewarm_lock:
+            if self.prewarm_thread is not None and \
+                    self.prewarm_thread.is_alive():
+                # prewarm already running
+                return
+            self.prewarm_thread = threading.Thread(
+                target=self.prewarm, daemon=True
+            )
+            self.prewarm_thread.start()
+
+    def prewarm(self):
+        """Prewarm project settings, map lookup and public viewer
+        permission caches.
+        """
+        try:
+            self.cache_project_settings()
+            self.cache_map_lookups()
+            # prewarm viewer permissions for anonymous users
+            self.service_permissions('qwc', {}, None, None)
+        except Exception as e:
+            self.logger.error("Prewarming caches failed:\n%s" % e)
+
     def cache_project_settings(self):
         return self.permission_handlers["ogc"].cache_project_settings()
+
+    def cache_map_lookups(self):
+        with self.session_scope() as session:
+            self.permission_handlers["data"].cache_map_lookups(session)
@@ -1,4 +1,7 @@
+import os
+
 from flask import json
+from sqlalchemy.orm import selectinload
 from sqlalchemy.sql import text as sql_text
 
 from permission_query import PermissionQuery
@@ -22,6 +25,19 @@ class DataServicePermission(PermissionQuery):
 
         self.db_engine = db_engine
 
+        # cache for QGS readers: {<map_name>: (<mtime>, <QGSReader>)}
+        self.qgs_reader_cache = {}
+
+        # prewarmed lookup of unambiguous data layer names to map names:
+        #     {<layer_name>: <map_name>}
+        self.data_layer_map_lookup = {}
+
+        # cache for column metadata of GeoDB tables:
+        #     {(<connection>, <schema>, <table>):
+        #         {<column>: {'data_type': <type>,
+        #                     'constraints': <constraints>}}}
+        self.column_metadata_cache = {}
+
     def permissions(self, params, username, group, session):
         """Query permissions for editing a dataset.
 
@@ -35,9 +51,50 @@ class DataServicePermission(PermissionQuery):
         :param str group: Group name
         :param Session session: DB session
         """
+        dataset = params.get('dataset', '')
+        return self.dataset_permissions(dataset, username, group, session)
+
+    def permissions_bulk(self, datasets, username, group, session):
+        """Query permissions for editing multiple datasets at once.
+
+        Return lookup of dataset edit permissions by dataset ID. The
+        permissions of the user are loaded only once for all datasets.
+
+        :param list[str] datasets: Dataset IDs
+        :param str username: User name
+        :param str group: Group name
+        :param Session session: DB session
+        """
+        Permission = self.Permission
+
+        results = {}
+        if not datasets:
+            return results
+
+        # load all permissions of user with their resources in one query
+        user_permissions = self.user_permissions_query(
+                username, group, session
+            ).options(selectinload(Permission.resource)).all()
+
+        for dataset in datasets:
+            results[dataset] = self.dataset_permissions(
+                dataset, username, group, session, user_permissions
+            )
+
+        return results
+
+    def dataset_permissions(self, dataset, username, group, session,
+                            user_permissions=None):
+        """Query permissions for editing a dataset.
+
+        :param str dataset: Dataset ID
+        :param str username: User name
+        :param str group: Group name
+        :param Session session: DB session
+        :param list user_permissions: Optional preloaded permissions of user
+        """
         permissions = {}
 
-        dataset = params.get('dataset', '')
         parts = dataset.split('.')
         if len(parts) > 1:
             map_name = parts[0]
@@ -48,13 +105,13 @@ class DataServicePermission(PermissionQuery):
             layer_name = dataset
 
         data_permissions = self.data_permissions(
-            map_name, layer_name, username, group, session
+            map_name, layer_name, username, group, session, user_permissions
         )
 
         if data_permissions['permitted']:
             # get layer metadata from QGIS project
-            qgs_reader = QGSReader(self.logger)
-            if qgs_reader.read(data_permissions['map_name']):
+            qgs_reader = self.qgs_reader(data_permissions['map_name'])
+            if qgs_reader is not None:
                 permissions = qgs_reader.layer_metadata(layer_name)
 
             if permissions:
@@ -76,7 +133,37 @@ class DataServicePermission(PermissionQuery):
 
         return permissions
 
-    def data_permissions(self, map_name, layer_name, username, group, session):
+    def qgs_reader(self, map_name):
+        """Return QGSReader for a map, reusing the cached reader while the
+        QGS project file is unchanged.
+
+        Return None if the QGS file could not be read.
+
+        :param str map_name: Map name
+        """
+        # get modification time of QGS project file
+        qgs_resources_path = os.environ.get('QGIS_RESOURCES_PATH', 'qgs/')
+        qgs_path = os.path.join(qgs_resources_path, '%s.qgs' % map_name)
+        mtime = None
+        if os.path.isfile(qgs_path):
+            mtime = os.path.getmtime(qgs_path)
+
+        cached = self.qgs_reader_cache.get(map_name)
+        if cached is not None and mtime is not None and cached[0] == mtime:
+            # reuse cached reader
+            return cached[1]
+
+        qgs_reader = QGSReader(self.logger)
+        if not qgs_reader.read(map_name):
+            return None
+
+        if mtime is not None:
+            self.qgs_reader_cache[map_name] = (mtime, qgs_reader)
+
+        return qgs_reader
+
+    def data_permissions(self, map_name, layer_name, username, group, session,
+                         user_permissions=None):
         """Query resource permissions and return whether map and data layer are
         permitted and writable (with CRUD permissions), and any restricted
         attributes.
@@ -88,45 +175,64 @@ class DataServicePermission(PermissionQuery):
         :param str username: User name
         :param str group: Group name
         :param Session session: DB session
+        :param list user_permissions: Optional preloaded permissions of user
         """
-        Permission = self.config_models.model('permissions')
-        Resource = self.config_models.model('resources')
+        Permission = self.Permission
+        Resource = self.Resource
+
+        data_resource_types = [
+            'data',
+            'data_create', 'data_read', 'data_update', 'data_delete'
+        ]
+
+        if user_permissions is None:
+            # load all permissions of user with their resources in one
+            # query and resolve data permissions in memory
+            user_permissions = self.user_permissions_query(
+                    username, group, session
+                ).options(selectinload(Permission.resource)).all()
 
         map_id = None
+        if map_name is None:
+            # try prewarmed lookup for unambiguous data layer names
+            # NOTE: the lookup is only a shortcut for resolving the map
+            #       of the layer and must not change the permission
+            #       decision, so fall back to resolving the map from
+            #       the user's data permissions below if no map
+            #       permission matches the prewarmed name
+            prewarmed_map_name = self.data_layer_map_lookup.get(layer_name)
+            if prewarmed_map_name is not None:
+                for permission in user_permissions:
+                    if permission.resource.type == 'map' and \
+                            permission.resource.name == prewarmed_map_name:
+                        map_name = prewarmed_map_name
+                        map_id = permission.resource.id
+                        break
+
         if map_name is None:
             # find map for data layer name
-            data_resource_types = [
-                'data',
-                'data_create', 'data_read', 'data_update', 'data_delete'
-            ]
-            data_query = self.user_permissions_query(
-                    username, group, session
-                ).join(Permission.resource). \
-                filter(Resource.type.in_(data_resource_types)). \
-                filter(Resource.name == layer_name). \
-                order_by(Permission.priority.desc()). \
-                distinct(Permission.priority)
-            # use data permission with highest priority
-            data_permission = data_query.first()
+            data_permission = self.highest_priority_permission([
+                p for p in user_permissions
+                if p.resource.type in data_resource_types
+                and p.resource.name == layer_name
+            ])
             if data_permission is not None:
                 map_id = data_permission.resource.parent_id
-                map_query = session.query(Resource). \
+                # NOTE: map resource may not be directly permitted,
+                #       so resolve its name from ConfigDB
+                map_name = session.query(Resource.name). \
                     filter(Resource.type == 'map'). \
-                    filter(Resource.id == map_id)
-                map_obj = map_query.first()
-                if map_obj is not None:
-                    map_name = map_obj.name
+                    filter(Resource.id == map_id).scalar()
+                if map_name is not None:
                     self.logger.info(
                         "No map name given, using map '%s'" % map_name
                     )
-        else:
-            # query map permissions
-            maps_query = self.user_permissions_query(
-                    username, group, session
-                ).join(Permission.resource).filter(Resource.type == 'map'). \
-                filter(Resource.name == map_name)
-            for map_permission in maps_query.all():
-                map_id = map_permission.resource.id
+        elif map_id is None:
+            # lookup map permissions
+            for permission in user_permissions:
+                if permission.resource.type == 'map' and \
+                        permission.resource.name == map_name:
+                    map_id = permission.resource.id
 
         if map_id is None:
             # map not found or not permitted
@@ -135,7 +241,7 @@ class DataServicePermission(PermissionQuery):
                 'permitted': False
             }
 
-        # query data permissions
+        # resolve data permissions
         permitted = False
         writable = False
         creatable = False
@@ -144,17 +250,17 @@ class DataServicePermission(PermissionQuery):
         deletable = False
         restricted_attributes = []
 
-        # NOTE: use permission with highest priority
-        base_query = self.user_permissions_query(username, group, session). \
-            join(Permission.resource). \
-            filter(Resource.parent_id == map_id). \
-            filter(Resource.name == layer_name). \
-            order_by(Permission.priority.desc()). \
-            distinct(Permission.priority)
-
-        # query 'data' permission
-        data_query = base_query.filter(Resource.type == 'data')
-        data_permission = data_query.first()
+        # permissions for data layer of map
+        layer_permissions = [
+            p for p in user_permissions
+            if p.resource.parent_id == map_id
+            and p.resource.name == layer_name
+        ]
+
+        # 'data' permission with highest priority
+        data_permission = self.highest_priority_permission(
+            layer_permissions, 'data'
+        )
         if data_permission is not None:
             # 'data' permitted
             permitted = True
@@ -164,26 +270,24 @@ class DataServicePermission(PermissionQuery):
             updatable = writable
             deletable = writable
 
-            # query attribute restrictions
+            # query attribute restrictions in one query
             attrs_query = self.resource_restrictions_query(
                 'attribute', username, group, session
             ).filter(Resource.parent_id == data_permission.resource_id)
-            for attr in attrs_query.all():
-                restricted_attributes.append(attr.name)
+            restricted_attributes = [
+                attr.name for attr in attrs_query
+            ]
 
         else:
-            # query detailed CRUD data permissions
-            create_query = base_query.filter(Resource.type == 'data_create')
-            creatable = create_query.first() is not None
-
-            read_query = base_query.filter(Resource.type == 'data_read')
-            readable = read_query.first() is not None
-
-            update_query = base_query.filter(Resource.type == 'data_update')
-            updatable = update_query.first() is not None
-
-            delete_query = base_query.filter(Resource.type == 'data_delete')
-            deletable = delete_query.first() is not None
+            # detailed CRUD data permissions
+            creatable = self.highest_priority_permission(
+                layer_permissions, 'data_create') is not None
+            readable = self.highest_priority_permission(
+                layer_permissions, 'data_read') is not None
+            updatable = self.highest_priority_permission(
+                layer_permissions, 'data_update') is not None
+            deletable = self.highest_priority_permission(
+                layer_permissions, 'data_delete') is not None
 
             permitted = creatable or readable or updatable or deletable
             writable = creatable and readable and updatable and deletable
@@ -201,15 +305,78 @@ class DataServicePermission(PermissionQuery):
             'restricted_attributes': restricted_attributes
         }
 
+    def highest_priority_permission(self, permissions, resource_type=None):
+        """Return permission with highest priority, optionally filtered by
+        resource type, or None.
+
+        :param list permissions: Permissions with loaded resources
+        :param str resource_type: Optional QWC resource type filter
+        """
+        if resource_type is not None:
+            permissions = [
+                p for p in permissions if p.resource.type == resource_type
+            ]
+        if permissions:
+            return max(permissions, key=lambda p: p.priority)
+        return None
+
+    def cache_map_lookups(self, session):
+        """Pre-populate lookup of data layer names to their map names with
+        one bulk resource query.
+
+        Ambiguous layer names occurring in multiple maps are skipped, as
+        they must be resolved by permission priority.
+
+        :param Session session: DB session
+        """
+        Resource = self.Resource
+
+        data_resource_types = [
+            'data',
+            'data_create', 'data_read', 'data_update', 'data_delete'
+        ]
+
+        # bulk load all resources
+        rows = session.query(
+            Resource.id, Resource.name, Resource.parent_id, Resource.type
+        ).all()
+        resource_by_id = {row.id: row for row in rows}
+
+        lookup = {}
+        ambiguous = set()
+        for row in rows:
+            if row.type not in data_resource_types:
+                continue
+
+            parent = resource_by_id.get(row.parent_id)
+            if parent is None or parent.type != 'map':
+                continue
+
+            if row.name in lookup and lookup[row.name] != parent.name:
+                ambiguous.add(row.name)
+            else:
+                lookup[row.name] = parent.name
+
+        for name in ambiguous:
+            del lookup[name]
+
+        self.data_layer_map_lookup = lookup
+        self.logger.info(
+            "Cached map lookup for %d data layers" % len(lookup)
+        )
+
     def filter_restricted_attributes(self, restricted_attributes, permissions):
         """Filter restricted attributes from Data service permissions.
 
         :param list[str] restricted_attributes: List of restricted attributes
         :param obj permissions: Data service permissions
         """
-        for attr in restricted_attributes:
-            if attr in permissions['attributes']:
-                permissions['attributes'].remove(attr)
+        # NOTE: preserve attribute order
+        restricted = set(restricted_attributes)
+        permissions['attributes'] = [
+            attr for attr in permissions['attributes']
+            if attr not in restricted
+        ]
 
     def lookup_attribute_data_types(self, permissions):
         """Query column data types and add them to Data service permissions.
@@ -221,58 +388,16 @@ class DataServicePermission(PermissionQuery):
             schema = permissions['schema']
             table_name = permissions['table_name']
 
-            # connect to GeoDB
-            geo_db = self.db_engine.db_engine(connection_string)
-            conn = geo_db.connect()
+            # get column metadata for table
+            columns = self.column_metadata(
+                connection_string, schema, table_name
+            )
 
             for attr in permissions['attributes']:
-                # build query SQL
-                sql = sql_text("""
-                    SELECT data_type, character_maximum_length,
-                        numeric_precision, numeric_scale
-                    FROM information_schema.columns
-                    WHERE table_schema = '{schema}' AND table_name = '{table}'
-                        AND column_name = '{column}'
-                    ORDER BY ordinal_position;
-                """.format(schema=schema, table=table_name, column=attr))
-
-                # execute query
-                data_type = None
-                constraints = {}
-                result = conn.execute(sql)
-                for row in result:
-                    data_type = row['data_type']
-
-                    # constraints from data type
-                    if (data_type in ['character', 'character varying'] and
-                            row['character_maximum_length']):
-                        constraints = {
-                            'maxlength': row['character_maximum_length']
-                        }
-                    elif data_type in ['double precision', 'real']:
-                        # NOTE: use text field with pattern for floats
-                        constraints['pattern'] = '[0-9]+([\\.,][0-9]+)?'
-                    elif data_type == 'numeric' and row['numeric_precision']:
-                        step = pow(10, -row['numeric_scale'])
-                        max_value = pow(
-                            10, row['numeric_precision'] - row['numeric_scale']
-                        ) - step
-                        constraints = {
-                            'numeric_precision': row['numeric_precision'],
-                            'numeric_scale': row['numeric_scale'],
-                            'min': -max_value,
-                            'max': max_value,
-                            'step': step
-                        }
-                    elif data_type == 'smallint':
-                        constraints = {'min': -32768, 'max': 32767}
-                    elif data_type == 'integer':
-                        constraints = {'min': -2147483648, 'max': 2147483647}
-                    elif data_type == 'bigint':
-                        constraints = {
-                            'min': '-9223372036854775808',
-                            'max': '9223372036854775807'
-                        }
+                column = columns.get(attr, {})
+                data_type = column.get('data_type')
+                # copy constraints as they may be merged below
+                constraints = dict(column.get('constraints', {}))
 
                 if attr not in permissions['fields']:
                     permissions['fields'][attr] = {}
@@ -296,11 +421,85 @@ class DataServicePermission(PermissionQuery):
                     # add constraints
                     permissions['fields'][attr]['constraints'] = constraints
 
-            # close database connection
-            conn.close()
-
         except Exception as e:
             self.logger.error(
                 "Error while querying attribute data types:\n\n%s" % e
             )
             raise
+
+    def column_metadata(self, connection_string, schema, table_name):
+        """Return data types and constraints for all columns of a table,
+        querying the GeoDB only on first call.
+
+        :param str connection_string: DB connection string
+        :param str schema: DB schema name
+        :param str table_name: DB table name
+        """
+        cache_key = (connection_string, schema, table_name)
+        columns = self.column_metadata_cache.get(cache_key)
+        if columns is not None:
+            return columns
+
+        columns = {}
+
+        # connect to GeoDB
+        geo_db = self.db_engine.db_engine(connection_string)
+        conn = geo_db.connect()
+
+        # query data types of all columns at once
+        sql = sql_text("""
+            SELECT column_name, data_type, character_maximum_length,
+                numeric_precision, numeric_scale
+            FROM information_schema.columns
+            WHERE table_schema = :schema AND table_name = :table
+            ORDER BY ordinal_position;
+        """)
+
+        # execute query
+        result = conn.execute(sql, schema=schema, table=table_name)
+        for row in result:
+            data_type = row['data_type']
+
+            # constraints from data type
+            constraints = {}
+            if (data_type in ['character', 'character varying'] and
+                    row['character_maximum_length']):
+                constraints = {
+                    'maxlength': row['character_maximum_length']
+                }
+            elif data_type in ['double precision', 'real']:
+                # NOTE: use text field with pattern for floats
+                constraints['pattern'] = '[0-9]+([\\.,][0-9]+)?'
+            elif data_type == 'numeric' and row['numeric_precision']:
+                step = pow(10, -row['numeric_scale'])
+                max_value = pow(
+                    10, row['numeric_precision'] - row['numeric_scale']
+                ) - step
+                constraints = {
+                    'numeric_precision': row['numeric_precision'],
+                    'numeric_scale': row['numeric_scale'],
+                    'min': -max_value,
+                    'max': max_value,
+                    'step': step
+                }
+            elif data_type == 'smallint':
+                constraints = {'min': -32768, 'max': 32767}
+            elif data_type == 'integer':
+                constraints = {'min': -2147483648, 'max': 2147483647}
+            elif data_type == 'bigint':
+                constraints = {
+                    'min': '-9223372036854775808',
+                    'max': '9223372036854775807'
+                }
+
+            columns[row['column_name']] = {
+                'data_type': data_type,
+                'constraints': constraints
+            }
+
+        # close database connection
+        conn.close()
+
+        self.column_metadata_cache[cache_key] = columns
+
+        return columns
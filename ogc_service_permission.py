@@ -1,20 +1,58 @@
+from concurrent.futures import ThreadPoolExecutor
+import copy
 import os
+import sys
+import threading
 from urllib.parse import urljoin
-from xml.etree import ElementTree
+try:
+    # use C-backed parser if available
+    from lxml import etree as ElementTree
+    LXML = True
+except ImportError:
+    from xml.etree import ElementTree
+    LXML = False
 
 from flask import json
 import requests
+from requests.adapters import HTTPAdapter
+from sqlalchemy import and_, or_
 from sqlalchemy.orm import aliased
 
 from permission_query import PermissionQuery
 
 
+# per-thread XML parsers (lxml parsers are not thread-safe)
+xml_parser_local = threading.local()
+
+
+def xml_parser():
+    """Return a hardened XML parser for the current thread, or None.
+
+    Disables entity expansion, DTD loading and network access, which are
+    both a security risk and an avoidable parsing cost.
+    """
+    if not LXML:
+        # xml.etree uses its default parser
+        return None
+    parser = getattr(xml_parser_local, 'parser', None)
+    if parser is None:
+        parser = ElementTree.XMLParser(
+            resolve_entities=False, load_dtd=False, no_network=True,
+            huge_tree=True, collect_ids=False
+        )
+        xml_parser_local.parser = parser
+    return parser
+
+
 class OGCServicePermission(PermissionQuery):
     """OGCServicePermission class
 
     Query permissions for an OGC service.
     """
 
+    # supported OWS types
+    OWS_TYPES = frozenset(['WMS', 'WFS'])
+
     def __init__(self, default_allow, config_models, logger, project_settings_cache):
         """Constructor
 
@@ -32,6 +70,19 @@ class OGCServicePermission(PermissionQuery):
 
         self.project_settings_cache = project_settings_cache
 
+        # HTTP session with keep-alive connection pool to QGIS server
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=50)
+        self.http.mount('http://', adapter)
+        self.http.mount('https://', adapter)
+
+        # cache for parsed permissions:
+        #     {(<ows_name>, <ows_type>): {'mtime': <mtime>,
+        #                                 'permissions': <permissions>}}
+        self.permissions_cache = {}
+        # lock for concurrent cache access
+        self.cache_lock = threading.RLock()
+
     def permissions(self, params, username, group, session):
         """Query permissions for OGC service.
 
@@ -48,8 +99,8 @@ class OGCServicePermission(PermissionQuery):
         ows_name = params.get('ows_name')
         ows_type = params.get('ows_type')
 
-        if ows_type not in ['WMS', 'WFS']:
-            # unsupported OWS type
+        if not ows_name or ows_type not in self.OWS_TYPES:
+            # missing OWS name or unsupported OWS type
             return permissions
 
         # get complete OGC service permissions from GetProjectSettings
@@ -57,23 +108,96 @@ class OGCServicePermission(PermissionQuery):
         if not permissions:
             return permissions
 
+        # load permitted and restricted map resources in bulk
+        resource_permissions = self.map_resource_permissions(
+            ows_name, username, group, session
+        )
+
+        return self.filter_permissions(
+            ows_name, permissions, resource_permissions
+        )
+
+    def permissions_bulk(self, ows_names, ows_type, username, group, session):
+        """Query permissions for multiple OGC services at once.
+
+        Return lookup of OGC service permissions by OWS service name.
+        Project settings are fetched concurrently and the map resource
+        permissions for all services are loaded with one pair of bulk
+        queries.
+
+        :param list[str] ows_names: OWS service names
+        :param str ows_type: OWS type
+        :param str username: User name
+        :param str group: Group name
+        :param Session session: DB session
+        """
+        results = {}
+
+        if ows_type not in self.OWS_TYPES:
+            # unsupported OWS type
+            return results
+
+        ows_names = [ows_name for ows_name in ows_names if ows_name]
+        if not ows_names:
+            return results
+
+        # get complete OGC service permissions from GetProjectSettings
+        # NOTE: fetch concurrently, as each lookup is dominated by I/O
+        #       to QGIS server
+        with ThreadPoolExecutor(
+            max_workers=min(len(ows_names), 8)
+        ) as executor:
+            parsed = dict(zip(ows_names, executor.map(
+                lambda ows_name: self.parseProjectSettings(
+                    ows_name, ows_type
+                ),
+                ows_names
+            )))
+
+        # load permitted and restricted resources of all map subtrees
+        # in bulk
+        resource_permissions = self.map_resource_permissions_bulk(
+            ows_names, username, group, session
+        )
+
+        for ows_name in ows_names:
+            permissions = parsed[ows_name]
+            if permissions:
+                permissions = self.filter_permissions(
+                    ows_name, permissions, resource_permissions[ows_name]
+                )
+            results[ows_name] = permissions
+
+        return results
+
+    def filter_permissions(self, ows_name, permissions, resource_permissions):
+        """Filter OGC service permissions against preloaded map resource
+        permissions.
+
+        :param str ows_name: OWS service name
+        :param obj permissions: OGC service permissions
+        :param obj resource_permissions: Materialized map resource
+                                         permissions
+        """
         permissions, map_id = self.filter_map_permissions(
-            self.default_allow, ows_name, permissions, username, group, session
+            self.default_allow, ows_name, permissions, resource_permissions
         )
         if map_id is None:
             return permissions
         permissions = self.filter_layer_permissions(
-            self.default_allow, map_id, permissions, username, group, session
+            self.default_allow, map_id, permissions, resource_permissions
         )
         permissions = self.filter_field_permissions(
-            map_id, permissions, username, group, session
+            map_id, permissions, resource_permissions
         )
         permissions = self.filter_print_template_permissions(
-            self.default_allow, map_id, permissions, username, group, session
+            self.default_allow, map_id, permissions, resource_permissions
         )
-        # remove group_layers
+        # remove temporary lookups
         if permissions:
             permissions.pop('group_layers', None)
+            permissions.pop('_alias_by_layer', None)
+            permissions.pop('_parent', None)
 
         return permissions
 
@@ -87,6 +211,24 @@ class OGCServicePermission(PermissionQuery):
             return os.path.getmtime(themes_config_path)
         return -1
 
+    def projectMTime(self, ows_name):
+        """Return modification time of QGS project file, or fall back to
+        themes config mtime if project file is not accessible.
+
+        :param str ows_name: OWS service name
+        """
+        qgs_resources_path = os.environ.get('QGIS_RESOURCES_PATH', 'qgs/')
+        qgs_path = os.path.join(qgs_resources_path, '%s.qgs' % ows_name)
+        if os.path.isfile(qgs_path):
+            return os.path.getmtime(qgs_path)
+
+        # fall back to themes config mtime if caching is enabled
+        cache = os.environ.get(
+            "__QWC_CONFIG_SERVICE_PROJECT_SETTINGS_CACHE", "0") == "1"
+        if cache:
+            return self.themesConfigMTime()
+        return -1
+
     def parseProjectSettings(self, ows_name, ows_type):
         """Get complete OGC service permissions from GetProjectSettings.
 
@@ -97,6 +239,16 @@ class OGCServicePermission(PermissionQuery):
         """
         permissions = {}
 
+        # check for cached permissions
+        mtime = self.projectMTime(ows_name)
+        cache_key = (ows_name, ows_type)
+        with self.cache_lock:
+            cached = self.permissions_cache.get(cache_key)
+            if cached is not None and mtime != -1 and \
+                    cached['mtime'] >= mtime:
+                # return copy of cached permissions
+                return copy.deepcopy(cached['permissions'])
+
         ows_url = urljoin(self.qgis_server_url, ows_name)
         cache = os.environ.get("__QWC_CONFIG_SERVICE_PROJECT_SETTINGS_CACHE", "0") == "1"
         if cache and \
@@ -107,33 +259,31 @@ class OGCServicePermission(PermissionQuery):
             self.logger.info("Using cached project settings for %s" % ows_url)
         else:
             # get GetProjectSettings
-            response = requests.get(
+            # NOTE: stream response body into XML parser instead of
+            #       buffering it completely, and close the response to
+            #       release the connection back to the pool
+            with self.http.get(
                 ows_url,
                 params={
                     'SERVICE': ows_type,
                     'VERSION': '1.3.0',
                     'REQUEST': 'GetProjectSettings'
                 },
+                stream=True,
                 timeout=30
-            )
-
-            if response.status_code != requests.codes.ok:
-                self.logger.warn(
-                    "Could not get GetProjectSettings from %s:\n%s",
-                    ows_url, response.content
-                )
-                return permissions
-
-            document = response.content
+            ) as response:
+                if response.status_code != requests.codes.ok:
+                    self.logger.warn(
+                        "Could not get GetProjectSettings from %s:\n%s",
+                        ows_url, response.content
+                    )
+                    return permissions
 
-            # parse GetProjectSettings XML
-            ElementTree.register_namespace('', 'http://www.opengis.net/wms')
-            ElementTree.register_namespace('qgs', 'http://www.qgis.org/wms')
-            ElementTree.register_namespace('sld', 'http://www.opengis.net/sld')
-            ElementTree.register_namespace(
-                'xlink', 'http://www.w3.org/1999/xlink'
-            )
-            root = ElementTree.fromstring(document)
+                # parse GetProjectSettings XML
+                response.raw.decode_content = True
+                root = ElementTree.parse(
+                    response.raw, xml_parser()
+                ).getroot()
 
             if cache:
                 self.project_settings_cache[ows_url] = {
@@ -142,19 +292,39 @@ class OGCServicePermission(PermissionQuery):
                 }
 
 
+        permissions = self.parsePermissions(root, ows_name, ows_url)
+
+        if permissions and mtime != -1:
+            # store copy of parsed permissions
+            # NOTE: permissions are filtered in place by callers
+            with self.cache_lock:
+                self.permissions_cache[cache_key] = {
+                    'mtime': mtime,
+                    'permissions': copy.deepcopy(permissions)
+                }
+
+        return permissions
+
+    def parsePermissions(self, root, ows_name, ows_url):
+        """Parse OGC service permissions from GetProjectSettings document.
+
+        :param Element root: GetProjectSettings root node
+        :param str ows_name: OWS service name
+        :param str ows_url: OWS service URL
+        """
+        permissions = {}
+
         # use default namespace for XML search
-        # namespace dict
-        ns = {'ns': 'http://www.opengis.net/wms'}
-        # namespace prefix
-        np = 'ns:'
+        # NOTE: use Clark notation tags to skip prefix resolution on
+        #       every find
+        wms_ns = '{http://www.opengis.net/wms}'
         if not root.tag.startswith('{http://'):
             # do not use namespace
-            ns = {}
-            np = ''
+            wms_ns = ''
 
-        root_layer = root.find('%sCapability/%sLayer' % (np, np), ns)
+        root_layer = root.find('%sCapability/%sLayer' % (wms_ns, wms_ns))
         if root_layer is None:
-            self.logger.warn("No root layer found: %s", response.content)
+            self.logger.warn("No root layer found for %s", ows_url)
             return permissions
 
         permissions = {
@@ -172,6 +342,12 @@ class OGCServicePermission(PermissionQuery):
             # sub layers ordered from bottom to top:
             #     {<group>: [<sub layers]}
             'restricted_group_layers': {},
+            # temporary inverse lookup for feature info aliases:
+            #     {<layer>: <feature info layer>}
+            '_alias_by_layer': {},
+            # temporary child to parent group lookup:
+            #     {<sub layer>: <group>}
+            '_parent': {},
             # temporary lookup for complete group layers
             'group_layers': {},
             # TODO: extract background layers
@@ -180,261 +356,385 @@ class OGCServicePermission(PermissionQuery):
             'print_templates': []
         }
 
+        # precompute tag names to avoid string formatting per layer
+        tags = {
+            'name': '%sName' % wms_ns,
+            'title': '%sTitle' % wms_ns,
+            'layer': '%sLayer' % wms_ns,
+            'attributes': '%sAttributes' % wms_ns,
+            'attribute': '%sAttribute' % wms_ns
+        }
+
         # collect layers from layer tree
-        self.collect_layers(root_layer, permissions, ns, np, ows_name)
+        self.collect_layers(root_layer, permissions, tags, ows_name)
 
         # collect print templates
-        for template in root.findall('.//%sComposerTemplate' % np, ns):
+        for template in root.findall('.//%sComposerTemplate' % wms_ns):
             template_name = template.get('name')
             permissions['print_templates'].append(template_name)
 
         return permissions
 
-    def collect_layers(self, layer, permissions, ns, np, fallback_name=""):
-        """Recursively collect layer info for layer subtree from
-        GetProjectSettings.
+    def collect_layers(self, root_layer, permissions, tags,
+                       fallback_name=""):
+        """Collect layer info for layer subtree from GetProjectSettings.
+
+        Walks the layer tree iteratively in document order.
 
-        :param Element layer: GetProjectSettings layer node
+        :param Element root_layer: GetProjectSettings root layer node
         :param obj permissions: partial OGC service permission
-        :param obj ns: Namespace dict
-        :param str np: Namespace prefix
+        :param obj tags: Precomputed tag names in Clark notation
         """
-        layer_name_tag = layer.find('%sName' % np, ns)
-        if layer_name_tag is not None:
-            layer_name = layer_name_tag.text
-        else:
-            layer_name = fallback_name
+        # stack of (<layer>, <fallback name>), top is next layer
+        stack = [(root_layer, fallback_name)]
+        while stack:
+            layer, fallback = stack.pop()
+
+            layer_name_tag = layer.find(tags['name'])
+            if layer_name_tag is not None:
+                # NOTE: intern repeated layer names to share string objects
+                layer_name = sys.intern(layer_name_tag.text)
+            else:
+                layer_name = fallback
+
+            layer_title_tag = layer.find(tags['title'])
+
+            permissions['public_layers'].append(layer_name)
+            if layer.get('queryable') == '1' and layer_title_tag is not None:
+                permissions['queryable_layers'].append(layer_name)
+                layer_title = sys.intern(layer_title_tag.text)
+                permissions['feature_info_aliases'][layer_title] = layer_name
+                permissions['_alias_by_layer'][layer_name] = layer_title
+
+            # collect sub layers if group layer
+            sub_layers = layer.findall(tags['layer'])
+            group_layers = []
+            for sub_layer in sub_layers:
+                sub_layer_name = sys.intern(sub_layer.find(tags['name']).text)
+                group_layers.append(sub_layer_name)
+                permissions['_parent'][sub_layer_name] = layer_name
+            if group_layers:
+                permissions['group_layers'][layer_name] = group_layers
+
+            # push sub layers in reverse to keep document order
+            for sub_layer in reversed(sub_layers):
+                stack.append((sub_layer, ""))
+
+            # collect attributes if data layer
+            attributes = []
+            attrs = layer.find(tags['attributes'])
+            if attrs is not None:
+                for attr in attrs.findall(tags['attribute']):
+                    attributes.append(attr.get('alias', attr.get('name')))
+                attributes.append('geometry')
+                attributes.append('maptip')
+
+            permissions['layers'][layer_name] = attributes
+
+    def map_resource_permissions(self, ows_name, username, group, session):
+        """Load all permitted and restricted resources of a map subtree
+        with two bulk queries.
+
+        Return lookup of resource rows by id and sets of permitted and
+        restricted resource ids, for dispatching the filters in memory.
+
+        :param str ows_name: Map name
+        :param str username: User name
+        :param str group: Group name
+        :param Session session: DB session
+        """
+        return self.map_resource_permissions_bulk(
+            [ows_name], username, group, session
+        )[ows_name]
+
+    def map_resource_permissions_bulk(self, ows_names, username, group,
+                                      session):
+        """Load all permitted and restricted resources of multiple map
+        subtrees with two bulk queries.
 
-        layer_title_tag = layer.find('%sTitle' % np, ns)
+        Return lookup by map name of resource rows by id and sets of
+        permitted and restricted resource ids, for dispatching the
+        filters in memory.
 
-        permissions['public_layers'].append(layer_name)
-        if layer.get('queryable') == '1' and layer_title_tag is not None:
-            permissions['queryable_layers'].append(layer_name)
-            layer_title = layer_title_tag.text
-            permissions['feature_info_aliases'][layer_title] = layer_name
+        :param list[str] ows_names: Map names
+        :param str username: User name
+        :param str group: Group name
+        :param Session session: DB session
+        """
+        Permission = self.Permission
+        Resource = self.Resource
+
+        # aliases for parent layer and map resources
+        parent = aliased(Resource)
+        grandparent = aliased(Resource)
+
+        names = set(ows_names)
+
+        # limit to resources of map subtrees
+        scope_filter = or_(
+            and_(Resource.type == 'map', Resource.name.in_(names)),
+            and_(parent.type == 'map', parent.name.in_(names)),
+            and_(grandparent.type == 'map', grandparent.name.in_(names))
+        )
 
-        # collect sub layers if group layer
-        group_layers = []
-        for sub_layer in layer.findall('%sLayer' % np, ns):
-            sub_layer_name = sub_layer.find('%sName' % np, ns).text
-            group_layers.append(sub_layer_name)
+        entities = (
+            Resource.id, Resource.type, Resource.name, Resource.parent_id,
+            parent.name.label('parent_name'),
+            parent.type.label('parent_type'),
+            parent.parent_id.label('grandparent_id'),
+            grandparent.name.label('grandparent_name'),
+            grandparent.type.label('grandparent_type')
+        )
 
-            self.collect_layers(sub_layer, permissions, ns, np)
+        # all resources of map subtrees with any permission
+        all_query = session.query(Permission). \
+            join(Permission.resource). \
+            outerjoin(parent, parent.id == Resource.parent_id). \
+            outerjoin(grandparent, grandparent.id == parent.parent_id). \
+            filter(scope_filter). \
+            with_entities(*entities)
+
+        # resources of map subtrees permitted for user
+        user_query = self.user_permissions_query(username, group, session). \
+            join(Permission.resource). \
+            outerjoin(parent, parent.id == Resource.parent_id). \
+            outerjoin(grandparent, grandparent.id == parent.parent_id). \
+            filter(scope_filter). \
+            with_entities(*entities)
+
+        def map_name(row):
+            """Return name of the map subtree a resource row belongs to."""
+            if row.type == 'map' and row.name in names:
+                return row.name
+            if row.parent_type == 'map' and row.parent_name in names:
+                return row.parent_name
+            if (row.grandparent_type == 'map'
+                    and row.grandparent_name in names):
+                return row.grandparent_name
+            return None
+
+        resource_permissions = {}
+        all_ids = {}
+        for name in ows_names:
+            resource_permissions[name] = {
+                # resource rows by id
+                'resources': {},
+                # permitted resource ids
+                'permitted': set(),
+                # restrictions without user permissions
+                'restricted': set()
+            }
+            all_ids[name] = set()
+
+        for row in all_query:
+            name = map_name(row)
+            if name is None:
+                continue
+            resource_permissions[name]['resources'][row.id] = row
+            all_ids[name].add(row.id)
 
-        if group_layers:
-            permissions['group_layers'][layer_name] = group_layers
+        for row in user_query:
+            name = map_name(row)
+            if name is None:
+                continue
+            resource_permissions[name]['resources'][row.id] = row
+            resource_permissions[name]['permitted'].add(row.id)
 
-        # collect attributes if data layer
-        attributes = []
-        attrs = layer.find('%sAttributes' % np, ns)
-        if attrs is not None:
-            for attr in attrs.findall('%sAttribute' % np, ns):
-                attributes.append(attr.get('alias', attr.get('name')))
-            attributes.append('geometry')
-            attributes.append('maptip')
+        for name in ows_names:
+            resource_permissions[name]['restricted'] = \
+                all_ids[name] - resource_permissions[name]['permitted']
 
-        permissions['layers'][layer_name] = attributes
+        return resource_permissions
 
-    def filter_map_permissions(self, default_allow,
-                               ows_name, permissions, username,
-                               group, session):
+    def filter_map_permissions(self, default_allow, ows_name, permissions,
+                               resource_permissions):
         """Filter permitted resources from OGC service permissions.
 
         Return filtered OGC service permissions and map_id.
 
         :param str ows_name: Map name
         :param obj permissions: OGC service permissions
-        :param str username: User name
-        :param str group: Group name
-        :param Session session: DB session
+        :param obj resource_permissions: Materialized map resource
+                                         permissions
         """
-        Permission = self.config_models.model('permissions')
-        Resource = self.config_models.model('resources')
+        resources = resource_permissions['resources']
 
         if default_allow:
-            # query map restrictions
-            maps_query = self.resource_restrictions_query(
-                    'map', username, group, session
-                ).filter(Resource.name == ows_name)
-
-            if maps_query.count() > 0:
-                # map not permitted
-                return {}, None
+            # check map restrictions
+            for res_id in resource_permissions['restricted']:
+                row = resources[res_id]
+                if row.type == 'map' and row.name == ows_name:
+                    # map not permitted
+                    return {}, None
         else:  # default_allow == False
-            maps_query = self.resource_permission_query(
-                    'map', username, group, session
-                ).filter(Resource.name == ows_name)
-
-            if maps_query.count() == 0:
+            if not any(
+                resources[res_id].type == 'map'
+                and resources[res_id].name == ows_name
+                for res_id in resource_permissions['permitted']
+            ):
                 # map not permitted
                 return {}, None
 
-        # get map_id
+        # get map_id from permitted map resource
         map_id = None
-        maps_query = self.resource_permission_query(
-                'map', username, group, session
-            ).filter(Resource.name == ows_name)
-        map_permission = maps_query.first()
-        if map_permission is not None:
-            map_id = map_permission.id
+        for res_id in resource_permissions['permitted']:
+            row = resources[res_id]
+            if row.type == 'map' and row.name == ows_name:
+                map_id = res_id
+                break
 
         return permissions, map_id
 
-    def filter_layer_permissions(self, default_allow,
-                                 map_id, permissions, username,
-                                 group, session):
-        Resource = self.config_models.model('resources')
+    def filter_layer_permissions(self, default_allow, map_id, permissions,
+                                 resource_permissions):
+        resources = resource_permissions['resources']
 
         if default_allow:
-            # query layer restrictions
-            layers_query = self.resource_restrictions_query(
-                    'layer', username, group, session
-                ).filter(Resource.parent_id == map_id)
-
             # remove restricted layers
-            for layer in layers_query.all():
-                self.filter_restricted_layer(layer.name, permissions)
-        else:  # default_allow == False
-            layers_query = self.resource_permission_query(
-                    'layer', username, group, session
-                ).filter(Resource.parent_id == map_id)
+            removed_layers = set()
+            for res_id in resource_permissions['restricted']:
+                row = resources[res_id]
+                if row.type == 'layer' and row.parent_id == map_id:
+                    self.filter_restricted_layer(
+                        row.name, permissions, removed_layers
+                    )
 
+            if removed_layers:
+                # remove collected layers from ordered lists in one pass
+                permissions['public_layers'] = [
+                    layer for layer in permissions['public_layers']
+                    if layer not in removed_layers
+                ]
+                permissions['queryable_layers'] = [
+                    layer for layer in permissions['queryable_layers']
+                    if layer not in removed_layers
+                ]
+        else:  # default_allow == False
             # filter permitted layers
-            self.filter_permitted_layers(layers_query.all(), permissions)
+            permitted_layers = [
+                resources[res_id].name
+                for res_id in resource_permissions['permitted']
+                if resources[res_id].type == 'layer'
+                and resources[res_id].parent_id == map_id
+            ]
+            self.filter_permitted_layers(permitted_layers, permissions)
 
         return permissions
 
-    def filter_field_permissions(self,
-                                 map_id, permissions, username,
-                                 group, session):
+    def filter_field_permissions(self, map_id, permissions,
+                                 resource_permissions):
         # Attributes are always default_allow == True
-        Resource = self.config_models.model('resources')
-
-        # query attribute restrictions
-        layer_alias = aliased(Resource)
-        attrs_query = self.resource_restrictions_query(
-                'attribute', username, group, session
-            )
-        # join to layer resources
-        attrs_query = attrs_query.join(
-                layer_alias, layer_alias.id == Resource.parent_id
-            )
-        # filter by map
-        attrs_query = attrs_query.filter(layer_alias.parent_id == map_id)
-        # include layer name
-        attrs_query = attrs_query.with_entities(
-                Resource.id, Resource.name, Resource.parent_id,
-                layer_alias.name.label('layer_name')
-            )
+        resources = resource_permissions['resources']
 
         # group restricted attributes by layer
         layers_attributes = {}
-        for attr in attrs_query.all():
-            if attr.layer_name not in layers_attributes:
-                layers_attributes[attr.layer_name] = []
-            layers_attributes[attr.layer_name].append(attr.name)
+        for res_id in resource_permissions['restricted']:
+            row = resources[res_id]
+            if row.type == 'attribute' and row.grandparent_id == map_id:
+                layers_attributes.setdefault(row.parent_name, set()). \
+                    add(row.name)
 
-        for layer in layers_attributes:
+        for layer, restricted_attrs in layers_attributes.items():
             # remove restricted attributes from permitted layers
             if layer in permissions['layers']:
-                layer_attrs = permissions['layers'][layer]
-                for attr in layers_attributes[layer]:
-                    if attr in layer_attrs:
-                        layer_attrs.remove(attr)
+                permissions['layers'][layer] = [
+                    attr for attr in permissions['layers'][layer]
+                    if attr not in restricted_attrs
+                ]
 
         return permissions
 
-    def filter_print_template_permissions(
-            self, default_allow, map_id, permissions, username, group,
-            session):
-        Permission = self.config_models.model('permissions')
-        Resource = self.config_models.model('resources')
+    def filter_print_template_permissions(self, default_allow, map_id,
+                                          permissions, resource_permissions):
+        resources = resource_permissions['resources']
 
         if default_allow:
-            # query print template restrictions
-            templates_query = self.resource_restrictions_query(
-                    'print_template', username, group, session
-                ).filter(Resource.parent_id == map_id)
-
             # remove restricted print templates
-            for template in templates_query.all():
-                if template.name in permissions['print_templates']:
-                    permissions['print_templates'].remove(template.name)
-
+            for res_id in resource_permissions['restricted']:
+                row = resources[res_id]
+                if row.type == 'print_template' and row.parent_id == map_id \
+                        and row.name in permissions['print_templates']:
+                    permissions['print_templates'].remove(row.name)
         else:  # default_allow == False
-            templates_query = self.resource_permission_query(
-                    'print_template', username, group, session
-                ).filter(Resource.parent_id == map_id)
+            permitted_templates = set(
+                resources[res_id].name
+                for res_id in resource_permissions['permitted']
+                if resources[res_id].type == 'print_template'
+                and resources[res_id].parent_id == map_id
+            )
             permissions['print_templates'] = list(
                 set(permissions['print_templates']).intersection(
-                    templates_query.all()))
+                    permitted_templates))
 
         return permissions
 
-    def filter_restricted_layer(self, restricted_layer, permissions):
+    def filter_restricted_layer(self, restricted_layer, permissions,
+                                removed_layers):
         """Recursively remove restricted layers.
 
+        Removed layer names are collected in removed_layers, so the
+        caller can filter the ordered layer lists in a single pass.
+
         :param str restricted_layer: Restricted layer name
         :param obj permissions: OGC service permissions
+        :param set removed_layers: Collected removed layer names
         """
         # remove restricted layer
         permissions['layers'].pop(restricted_layer, None)
-        if restricted_layer in permissions['queryable_layers']:
-            permissions['queryable_layers'].remove(restricted_layer)
-        if restricted_layer in permissions['public_layers']:
-            permissions['public_layers'].remove(restricted_layer)
+        removed_layers.add(restricted_layer)
 
         # remove restricted layer from feature_info_aliases
-        feature_info_alias = None
-        for alias in permissions['feature_info_aliases']:
-            if permissions['feature_info_aliases'][alias] == restricted_layer:
-                feature_info_alias = alias
-                break
+        # NOTE: use inverse lookup instead of scanning all aliases
+        feature_info_alias = permissions['_alias_by_layer'].pop(
+            restricted_layer, None
+        )
         if feature_info_alias is not None:
-            permissions['feature_info_aliases'].pop(feature_info_alias)
+            permissions['feature_info_aliases'].pop(feature_info_alias, None)
 
         # update restricted_group_layers
-        restricted_group_layers = permissions['restricted_group_layers']
-        for group_layer in permissions['group_layers']:
-            # find restricted layer in group_layers
-            sub_layers = permissions['group_layers'][group_layer]
-            if restricted_layer in sub_layers:
-                if group_layer not in restricted_group_layers:
-                    # add restricted group if not present
-                    restricted_group_layers[group_layer] = sub_layers.copy()
-
-                # remove restricted layer
-                restricted_group_layers[group_layer].remove(restricted_layer)
-                if not restricted_group_layers[group_layer]:
-                    # remove empty restricted group
-                    restricted_group_layers.pop(group_layer, None)
-
-                    # remove empty group layer
-                    self.filter_restricted_layer(
-                        group_layer, permissions
-                    )
-
-                break
+        # NOTE: use child to parent lookup instead of scanning all groups
+        group_layer = permissions['_parent'].get(restricted_layer)
+        if group_layer is not None:
+            restricted_group_layers = permissions['restricted_group_layers']
+            if group_layer not in restricted_group_layers:
+                # add restricted group if not present
+                restricted_group_layers[group_layer] = \
+                    permissions['group_layers'][group_layer].copy()
+
+            # remove restricted layer
+            restricted_group_layers[group_layer].remove(restricted_layer)
+            if not restricted_group_layers[group_layer]:
+                # remove empty restricted group
+                restricted_group_layers.pop(group_layer, None)
+
+                # remove empty group layer
+                self.filter_restricted_layer(
+                    group_layer, permissions, removed_layers
+                )
 
     def filter_permitted_layers(self, permitted_layers, permissions):
         """Recursively remove restricted layers.
 
-        :param str permitted_layers: Permitted layers
+        :param list[str] permitted_layers: Permitted layer names
         :param obj permissions: OGC service permissions
         """
-        layer_names = list(map(lambda l: l.name, permitted_layers))
-        permissions['public_layers'] = list(
-            set(permissions['public_layers']).intersection(layer_names))
-        permissions['queryable_layers'] = list(
-            set(permissions['queryable_layers']).intersection(layer_names))
+        # NOTE: use set for fast lookups, filter ordered lists in place
+        permitted = set(permitted_layers)
+        permissions['public_layers'] = [
+            l for l in permissions['public_layers'] if l in permitted
+        ]
+        permissions['queryable_layers'] = [
+            l for l in permissions['queryable_layers'] if l in permitted
+        ]
         permissions['layers'] = {
-            l: permissions['layers'][l] for l in layer_names
+            l: attrs for l, attrs in permissions['layers'].items()
+            if l in permitted
         }
 
         # filter feature_info_aliases
         permissions['feature_info_aliases'] = {
             k: v for k, v in permissions['feature_info_aliases'].items()
-            if v in layer_names
+            if v in permitted
         }
 
         # update restricted_group_layers
@@ -469,7 +769,7 @@ class OGCServicePermission(PermissionQuery):
                 continue
 
             ows_name = url[len(self.qgis_server_url):]
-            response = requests.get(
+            response = self.http.get(
                 urljoin(self.qgis_server_url, ows_name),
                 params={
                     'SERVICE': "WMS",
@@ -484,17 +784,22 @@ class OGCServicePermission(PermissionQuery):
                 document = response.content
 
                 # parse GetProjectSettings XML
-                ElementTree.register_namespace('', 'http://www.opengis.net/wms')
-                ElementTree.register_namespace('qgs', 'http://www.qgis.org/wms')
-                ElementTree.register_namespace('sld', 'http://www.opengis.net/sld')
-                ElementTree.register_namespace(
-                    'xlink', 'http://www.w3.org/1999/xlink'
-                )
-                root = ElementTree.fromstring(document)
+                root = ElementTree.fromstring(document, xml_parser())
 
                 self.project_settings_cache[url] = {
                     "document": root,
                     "timestamp": mtime
                 }
+
+                # pre-populate permissions cache
+                permissions = self.parsePermissions(root, ows_name, url)
+                project_mtime = self.projectMTime(ows_name)
+                if permissions and project_mtime != -1:
+                    with self.cache_lock:
+                        self.permissions_cache[(ows_name, 'WMS')] = {
+                            'mtime': project_mtime,
+                            'permissions': permissions
+                        }
+
                 cached.append(ows_name)
         return {"cached_settings": cached}
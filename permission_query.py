@@ -1,4 +1,5 @@
-from sqlalchemy import distinct
+from sqlalchemy import distinct, exists, or_
+from sqlalchemy.orm import aliased, selectinload
 from sqlalchemy.sql import text as sql_text
 
 
@@ -20,6 +21,13 @@ class PermissionQuery:
         self.config_models = config_models
         self.logger = logger
 
+        # resolve ORM models once
+        self.Permission = config_models.model('permissions')
+        self.Resource = config_models.model('resources')
+        self.Role = config_models.model('roles')
+        self.Group = config_models.model('groups')
+        self.User = config_models.model('users')
+
     def permissions(self, params, username, group, session):
         """Query permissions for a QWC resource and dataset.
 
@@ -44,21 +52,31 @@ class PermissionQuery:
         :param str group: Group name
         :param Session session: DB session
         """
-        Permission = self.config_models.model('permissions')
-        Resource = self.config_models.model('resources')
-
-        # base query for all permissions of user
-        query = self.user_permissions_query(username, group, session)
-
-        # filter permissions by QWC resource type and name
-        query = query.join(Permission.resource) \
-            .filter(Resource.type == resource_type) \
-            .filter(Resource.name == resource_name)
-
+        Permission = self.Permission
+        Resource = self.Resource
+
+        # ids of all permissions of user
+        # NOTE: filter with an IN subquery instead of stacking onto the
+        #       base query, which already carries DISTINCT ON
+        #       (permissions.id) and would accumulate the criteria into
+        #       an invalid DISTINCT ON/ORDER BY combination
+        user_permission_ids = self.user_permissions_query(
+            username, group, session
+        ).with_entities(Permission.id).subquery()
+
+        # filter permissions by QWC resource type and name,
         # order by priority
-        query = query.order_by(Permission.priority.desc()) \
+        query = session.query(Permission) \
+            .join(Permission.resource) \
+            .filter(Resource.type == resource_type) \
+            .filter(Resource.name == resource_name) \
+            .filter(Permission.id.in_(user_permission_ids)) \
+            .order_by(Permission.priority.desc()) \
             .distinct(Permission.priority)
 
+        # eager-load resources to avoid lazy loads on returned rows
+        query = query.options(selectinload(Permission.resource))
+
         # execute query and return results
         return query.all()
 
@@ -72,22 +90,23 @@ class PermissionQuery:
         :param str group: Group name
         :param Session session: DB session
         """
-        Permission = self.config_models.model('permissions')
-        Resource = self.config_models.model('resources')
-
-        # all resource restrictions
-        all_restrictions = session.query(Permission). \
-            join(Permission.resource). \
-            with_entities(Resource.id, Resource.name, Resource.parent_id). \
-            filter(Resource.type == resource_type)
+        Permission = self.Permission
+        Resource = self.Resource
 
         # resource permissions for user
         user_permissions = self.resource_permission_query(
             resource_type, username, group, session
-        )
+        ).subquery()
 
         # restrictions without user permissions
-        restrictions_query = all_restrictions.except_(user_permissions)
+        # NOTE: anti-join with NOT EXISTS instead of EXCEPT, so the DB
+        #       does not have to materialize and sort both sides
+        restrictions_query = session.query(Permission). \
+            join(Permission.resource). \
+            with_entities(Resource.id, Resource.name, Resource.parent_id). \
+            filter(Resource.type == resource_type). \
+            filter(~exists().where(user_permissions.c.id == Resource.id)). \
+            distinct()
 
         return restrictions_query
 
@@ -101,8 +120,8 @@ class PermissionQuery:
         :param str group: Group name
         :param Session session: DB session
         """
-        Permission = self.config_models.model('permissions')
-        Resource = self.config_models.model('resources')
+        Permission = self.Permission
+        Resource = self.Resource
 
         # resource permissions for user
         user_permissions = \
@@ -123,40 +142,32 @@ class PermissionQuery:
         :param str group: Group name
         :param Session session: DB session
         """
-        Permission = self.config_models.model('permissions')
-        Role = self.config_models.model('roles')
-        Group = self.config_models.model('groups')
-        User = self.config_models.model('users')
-
-        # create query
-        query = session.query(Permission)
-
-        # filter by username and group
-        # NOTE: use nested JOINs to filter early and avoid too many rows
-        #       from cartesian product
-        # query permissions from roles in user groups
-        groups_roles_query = query.join(Permission.role) \
-            .join(Role.groups_collection) \
-            .join(Group.users_collection) \
-            .filter(User.name == username)
-
-        # query permissions from direct user roles
-        user_roles_query = query.join(Permission.role) \
-            .join(Role.users_collection) \
-            .filter(User.name == username)
-
-        # query permissions from group roles
-        group_roles_query = query.join(Permission.role) \
-            .join(Role.groups_collection) \
-            .filter(Group.name == group)
-
-        # query permissions from public role
-        public_roles_query = query.join(Permission.role) \
-            .filter(Role.name == self.PUBLIC_ROLE_NAME)
-
-        # combine queries
-        query = groups_roles_query.union(user_roles_query) \
-            .union(group_roles_query).union(public_roles_query)
+        Permission = self.Permission
+        Role = self.Role
+        Group = self.Group
+        User = self.User
+
+        # aliases for direct user roles and group memberships, so both
+        # can be referenced independently in the filter
+        direct_user = aliased(User)
+        group_user = aliased(User)
+
+        # combine permissions from roles in user groups, direct user
+        # roles, group roles and public role in a single query
+        # NOTE: use outer joins with a combined filter instead of a
+        #       UNION of separate queries, so the statement is planned
+        #       and compiled only once
+        query = session.query(Permission) \
+            .join(Permission.role) \
+            .outerjoin(Role.users_collection.of_type(direct_user)) \
+            .outerjoin(Role.groups_collection) \
+            .outerjoin(Group.users_collection.of_type(group_user)) \
+            .filter(or_(
+                group_user.name == username,
+                direct_user.name == username,
+                Group.name == group,
+                Role.name == self.PUBLIC_ROLE_NAME
+            ))
 
         # unique permissions
         query = query.distinct(Permission.id)
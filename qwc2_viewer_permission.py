@@ -1,11 +1,36 @@
+from collections import deque
+import copy
 import os
 from flask import json, safe_join
-from werkzeug.urls import url_parse
+from sqlalchemy.orm import selectinload
 
 from permission_query import PermissionQuery
 from themes_config import genThemes
 
 
+def url_path(url):
+    """Return the path component of an URL or path string.
+
+    Avoids a full werkzeug url_parse for the common case of extracting
+    the WMS name from a theme URL.
+
+    :param str url: URL or path
+    """
+    i = url.find('://')
+    if i >= 0:
+        # strip scheme and netloc
+        j = url.find('/', i + 3)
+        url = url[j:] if j >= 0 else '/'
+
+    # strip any query string and fragment
+    for sep in ('?', '#'):
+        k = url.find(sep)
+        if k >= 0:
+            url = url[:k]
+
+    return url
+
+
 class QWC2ViewerPermission(PermissionQuery):
     '''QWC2ViewerPermission class
 
@@ -72,9 +97,13 @@ class QWC2ViewerPermission(PermissionQuery):
         # get internal QGIS server URL from ENV
         qgis_server_url = os.environ.get('QGIS_SERVER_URL',
                                          'http://localhost/wms/').rstrip('/') + '/'
-        self.qgis_server_base_path = url_parse(qgis_server_url).path
+        self.qgis_server_base_path = url_path(qgis_server_url)
         self.project_settings_cache = project_settings_cache
 
+        # cache for parsed themes configs:
+        #     {<path>: (<mtime>, <config>)}
+        self.themes_config_cache = {}
+
     def permissions(self, params, username, group, session):
         '''Query permissions for QWC service.
 
@@ -87,8 +116,16 @@ class QWC2ViewerPermission(PermissionQuery):
         '''
         viewer = params.get('viewer')
 
+        # materialize all permissions of user once with preloaded
+        # resources and reuse them for the viewer, map and edit dataset
+        # lookups below, instead of re-querying per theme
+        Permission = self.Permission
+        user_permissions = self.user_permissions_query(
+            username, group, session
+        ).options(selectinload(Permission.resource)).all()
+
         # get viewer permissions
-        viewer_permissions = self.viewer_permissions(username, group, session)
+        viewer_permissions = self.viewer_permissions(user_permissions)
 
         # get themes from QWC2 themes config
         themes_config_path = None
@@ -101,8 +138,7 @@ class QWC2ViewerPermission(PermissionQuery):
                 self.logger.debug(
                     "Using custom viewer themes config '%s'" % filename
                 )
-                with open(themes_config_path, encoding='utf-8') as fh:
-                    config = json.load(fh)
+                config = self.load_themes_config(themes_config_path)
             except Exception as e:
                 self.logger.error(
                     "Could not load custom viewer themes config '%s':\n%s" %
@@ -114,8 +150,7 @@ class QWC2ViewerPermission(PermissionQuery):
             # load default themes config
             try:
                 themes_config_path = self.themes_config_path
-                with open(themes_config_path, encoding='utf-8') as fh:
-                    config = json.load(fh)
+                config = self.load_themes_config(themes_config_path)
             except Exception as e:
                 self.logger.error(
                     "Could not load default themes config:\n%s" % e
@@ -124,149 +159,217 @@ class QWC2ViewerPermission(PermissionQuery):
 
         # query WMS permissions for each theme
         permissions = {}
-        self.themes_group_permissions(
-            config.get('themes', {}), permissions, username, group, session
-        )
+        if user_permissions or self.default_allow:
+            self.themes_group_permissions(
+                config.get('themes', {}), permissions, username, group,
+                user_permissions, session
+            )
+        # NOTE: without any permissions and DEFAULT_ALLOW disabled, no
+        #       theme can be permitted, so skip the theme walk entirely
 
-        result = genThemes(themes_config_path, permissions, self.project_settings_cache)
+        # NOTE: pass a copy of the cached config, as genThemes modifies it
+        result = genThemes(
+            themes_config_path, permissions, self.project_settings_cache,
+            config=copy.deepcopy(config)
+        )
 
         # add viewer permissions
         result['viewers'] = viewer_permissions
 
         # add viewer task permissions
         result['viewer_tasks'] = self.viewer_task_permissions(
-            username, group, session
+            user_permissions, session
         )
 
         return result
 
+    def load_themes_config(self, path):
+        """Return parsed themes config, cached by file mtime.
+
+        :param str path: Path to themes config file
+        """
+        mtime = os.path.getmtime(path)
+        cached = self.themes_config_cache.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        with open(path, encoding='utf-8') as fh:
+            config = json.load(fh)
+
+        # precompute WMS names for theme items, as the URLs are static
+        # for the lifetime of the cached config
+        self.index_wms_names(config.get('themes', {}))
+
+        self.themes_config_cache[path] = (mtime, config)
+
+        return config
+
+    def index_wms_names(self, group_config):
+        """Precompute the WMS name for each theme item in a group and its
+        sub groups.
+
+        :param obj group_config: Sub config for theme group
+        """
+        groups = deque([group_config])
+        while groups:
+            group = groups.popleft()
+
+            for item in group.get('items', []):
+                url = item.get('url')
+                if url:
+                    # get WMS name as relative path to QGIS server base path
+                    wms_name = url_path(url)
+                    if wms_name.startswith(self.qgis_server_base_path):
+                        wms_name = wms_name[len(self.qgis_server_base_path):]
+                    item['_wms_name'] = wms_name
+
+            # queue sub groups
+            groups.extend(group.get('groups', []))
+
     def themes_group_permissions(self, group_config, permissions, username,
-                                 group, session):
-        """Recursively collect WMS and edit permissions for each theme in a
-        group.
+                                 group, user_permissions, session):
+        """Collect WMS and edit permissions for each theme in a group.
+
+        WMS permissions for all themes are queried with one bulk lookup,
+        which fetches project settings concurrently and loads the map
+        resource permissions with a single pair of queries.
 
         :param obj group_config: Sub config for theme group
         :param obj permissions: Collected WMS and edit permissions
         :param str username: User name
         :param str group: Group name
+        :param list user_permissions: Materialized permissions of user
         :param Session session: DB session
         """
-        theme_items = group_config.get('items', [])
-        for item in theme_items:
-            url = item.get('url')
-            if url:
-                # get WMS name as relative path to QGIS server base path
-                wms_name = url_parse(url).path
-                if wms_name.startswith(self.qgis_server_base_path):
-                    wms_name = wms_name[len(self.qgis_server_base_path):]
-
-                # query WMS permissions
-                ogc_params = {'ows_type': 'WMS', 'ows_name': wms_name}
-                permissions[wms_name] = self.ogc_permission_handler.permissions(
-                    ogc_params, username, group, session
-                )
+        # collect WMS names of all themes
+        wms_names = []
+        self.collect_wms_names(group_config, wms_names)
+        # unique WMS names, preserving order
+        wms_names = list(dict.fromkeys(wms_names))
+        if not wms_names:
+            return
+
+        # query WMS permissions for all themes in one batch
+        results = self.ogc_permission_handler.permissions_bulk(
+            wms_names, 'WMS', username, group, session
+        )
 
-                if permissions[wms_name]:
-                    # query edit permissions
-                    edit_config = self.edit_permissions(
-                        wms_name, username, group, session
-                    )
-                    if edit_config:
-                        permissions[wms_name]['edit_config'] = edit_config
-
-        groups = group_config.get('groups', [])
-        for sub_group in groups:
-            # collect sub group permissions
-            self.themes_group_permissions(
-                sub_group, permissions, username, group, session
+        for wms_name in wms_names:
+            wms_permissions = results.get(wms_name, {})
+            if not wms_permissions:
+                # skip themes without WMS permissions; genThemes treats
+                # missing entries same as empty permissions
+                continue
+            permissions[wms_name] = wms_permissions
+
+            # query edit permissions
+            edit_config = self.edit_permissions(
+                wms_name, username, group, user_permissions, session
             )
+            if edit_config:
+                wms_permissions['edit_config'] = edit_config
+
+    def collect_wms_names(self, group_config, wms_names):
+        """Collect WMS names for all themes in a group and its sub groups.
 
-    def edit_permissions(self, map_name, username, group, session):
+        Walks the theme groups iteratively to avoid recursion depth
+        limits for deeply nested configs.
+
+        :param obj group_config: Sub config for theme group
+        :param list wms_names: Collected WMS names
+        """
+        groups = deque([group_config])
+        while groups:
+            group = groups.popleft()
+
+            for item in group.get('items', []):
+                # use WMS name precomputed at config load
+                wms_name = item.get('_wms_name')
+                if wms_name is not None:
+                    wms_names.append(wms_name)
+
+            # queue sub groups
+            groups.extend(group.get('groups', []))
+
+    def edit_permissions(self, map_name, username, group, user_permissions,
+                         session):
         """Query edit permissions for a theme.
 
         :param str map_name: Map name (matches WMS and QGIS project)
         :param str username: User name
         :param str group: Group name
+        :param list user_permissions: Materialized permissions of user
         :param Session session: DB session
         """
         edit_config = {}
 
-        edit_datasets = self.edit_datasets(map_name, username, group, session)
-        for dataset in edit_datasets:
+        edit_datasets = self.edit_datasets(map_name, user_permissions)
+        if not edit_datasets:
+            return edit_config
+
+        # query data permissions for all datasets in one batch
+        datasets = [
+            "%s.%s" % (map_name, layer_name) for layer_name in edit_datasets
+        ]
+        dataset_permissions = self.data_permission_handler.permissions_bulk(
+            datasets, username, group, session
+        )
+
+        for layer_name, dataset in zip(edit_datasets, datasets):
             edit_layer_config = self.edit_layer_config(
-                map_name, dataset, username, group, session
+                layer_name, dataset, dataset_permissions.get(dataset, {})
             )
             if edit_layer_config:
-                edit_config[dataset] = edit_layer_config
+                edit_config[layer_name] = edit_layer_config
 
         return edit_config
 
-    def edit_datasets(self, map_name, username, group, session):
+    def edit_datasets(self, map_name, user_permissions):
         """Get permitted edit datasets for a map.
 
         :param str map_name: Map name
-        :param str username: User name
-        :param str group: Group name
-        :param Session session: DB session
+        :param list user_permissions: Materialized permissions of user
         """
-        Permission = self.config_models.model('permissions')
-        Resource = self.config_models.model('resources')
-
-        # query map permissions
-        maps_query = self.user_permissions_query(username, group, session). \
-            join(Permission.resource).filter(Resource.type == 'map'). \
-            filter(Resource.name == map_name). \
-            distinct(Resource.name)
+        # find permitted map
         map_id = None
-        for map_permission in maps_query.all():
-            map_id = map_permission.resource.id
+        for permission in user_permissions:
+            resource = permission.resource
+            if resource.type == 'map' and resource.name == map_name:
+                map_id = resource.id
+                break
 
         if map_id is None:
             # map not found or not permitted
             return []
 
-        # query writable data permissions
-        edit_datasets = []
-        data_resource_types = [
+        # collect writable data permissions
+        # NOTE: dict preserves insertion order and deduplicates in O(1)
+        edit_datasets = {}
+        data_resource_types = frozenset([
             'data',
             'data_create', 'data_update', 'data_delete'
-        ]
-        data_query = self.user_permissions_query(username, group, session). \
-            join(Permission.resource). \
-            filter(Resource.type.in_(data_resource_types)). \
-            filter(Resource.parent_id == map_id)
-        for data_permission in data_query.all():
-            if (
-                data_permission.resource.type == 'data'
-                and not data_permission.write
-            ):
+        ])
+        for data_permission in user_permissions:
+            resource = data_permission.resource
+            if resource.type not in data_resource_types \
+                    or resource.parent_id != map_id:
+                continue
+            if resource.type == 'data' and not data_permission.write:
                 # skip read-only 'data'
                 continue
 
             # collect distinct datasets
-            if data_permission.resource.name not in edit_datasets:
-                edit_datasets.append(data_permission.resource.name)
+            edit_datasets.setdefault(resource.name)
 
-        return edit_datasets
+        return list(edit_datasets)
 
-    def edit_layer_config(self, map_name, layer_name, username, group,
-                          session):
+    def edit_layer_config(self, layer_name, dataset, permissions):
         """Get permitted edit config for a dataset.
 
-        :param str map_name: Map name
         :param str layer_name: Data layer name
-        :param str username: User name
-        :param str group: Group name
-        :param Session session: DB session
+        :param str dataset: Dataset ID
+        :param obj permissions: Data service permissions for dataset
         """
-        dataset = "%s.%s" % (map_name, layer_name)
-
-        # query data permissions
-        data_params = {'dataset': dataset}
-        permissions = self.data_permission_handler.permissions(
-            data_params, username, group, session
-        )
-
         if not permissions:
             # data permissions are empty
             self.logger.warn(
@@ -342,64 +445,55 @@ class QWC2ViewerPermission(PermissionQuery):
             'geomType': geometry_type
         }
 
-    def viewer_permissions(self, username, group, session):
+    def viewer_permissions(self, user_permissions):
         """Get permitted viewers.
 
-        :param str username: User name
-        :param str group: Group name
-        :param Session session: DB session
+        :param list user_permissions: Materialized permissions of user
         """
-        Permission = self.config_models.model('permissions')
-        Resource = self.config_models.model('resources')
-
-        # query viewer permissions
+        # collect distinct permitted viewers
         viewers = []
-        viewers_query = self.user_permissions_query(
-                username, group, session
-            ).join(Permission.resource). \
-            filter(Resource.type == 'viewer'). \
-            distinct(Resource.name)
-        for permission in viewers_query.all():
-            viewers.append(permission.resource.name)
+        for permission in user_permissions:
+            resource = permission.resource
+            if resource.type == 'viewer' and resource.name not in viewers:
+                viewers.append(resource.name)
 
         return viewers
 
-    def viewer_task_permissions(self, username, group, session):
+    def viewer_task_permissions(self, user_permissions, session):
         """Get permitted viewer tasks.
 
-        :param str username: User name
-        :param str group: Group name
+        :param list user_permissions: Materialized permissions of user
         :param Session session: DB session
         """
-        Permission = self.config_models.model('permissions')
-        Resource = self.config_models.model('resources')
+        Permission = self.Permission
+        Resource = self.Resource
 
-        # query viewer permissions
         viewer_tasks = {}
 
-        # collect permittable viewer tasks
-        permittable_tasks_query = session.query(Resource). \
-            filter(Resource.type == 'viewer_task'). \
-            distinct(Resource.name)
-        permittable_tasks = [r.name for r in permittable_tasks_query.all()]
-
-        if self.default_allow:
-            # query viewer task restrictions
-            viewer_tasks_query = self.resource_restrictions_query(
-                'viewer_task', username, group, session
-            )
-            restricted_tasks = [r.name for r in viewer_tasks_query.all()]
-
-            for task in permittable_tasks:
-                viewer_tasks[task] = task not in restricted_tasks
-        else:
-            # query viewer task permissions
-            viewer_tasks_query = self.resource_permission_query(
-                'viewer_task', username, group, session
-            )
-            permitted_tasks = [r.name for r in viewer_tasks_query.all()]
+        # collect permitted viewer tasks of user
+        permitted_tasks = set(
+            p.resource.name for p in user_permissions
+            if p.resource.type == 'viewer_task'
+        )
 
-            for task in permittable_tasks:
-                viewer_tasks[task] = task in permitted_tasks
+        # query permittable viewer tasks together with whether any
+        # permissions exist for them
+        # NOTE: single round trip instead of separate permittable and
+        #       restricted/permitted queries
+        has_permissions = session.query(Permission.id). \
+            filter(Permission.resource_id == Resource.id).exists()
+        tasks_query = session.query(
+                Resource.name, has_permissions.label('has_permissions')
+            ).filter(Resource.type == 'viewer_task').distinct()
+
+        for name, task_has_permissions in tasks_query:
+            if self.default_allow:
+                # task is permitted unless restricted for user
+                permitted = not task_has_permissions \
+                    or name in permitted_tasks
+            else:
+                # task is permitted only with explicit permission
+                permitted = name in permitted_tasks
+            viewer_tasks[name] = viewer_tasks.get(name, True) and permitted
 
         return viewer_tasks
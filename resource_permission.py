@@ -1,5 +1,3 @@
-from sqlalchemy.orm import joinedload
-
 from permission_query import PermissionQuery
 
 
@@ -27,15 +25,30 @@ class ResourcePermission(PermissionQuery):
         name = params.get('name')
         parent_id = params.get('parent_id')
 
-        Permission = self.config_models.model('permissions')
-        Resource = self.config_models.model('resources')
-
-        query = self.user_permissions_query(username, group, session) \
-            .join(Permission.resource).filter(Resource.type == resource_type) \
-            .order_by(Permission.priority) \
-            .distinct(Permission.priority)
-        # eager load relations
-        query = query.options(joinedload(Permission.resource))
+        Permission = self.Permission
+        Resource = self.Resource
+
+        # ids of all permissions of user
+        user_permission_ids = self.user_permissions_query(
+            username, group, session
+        ).with_entities(Permission.id).subquery()
+
+        # select only the highest priority permission per resource
+        # (DISTINCT ON (resource_id) ... ORDER BY resource_id,
+        # priority DESC), instead of shipping all rows and overriding
+        # lower priorities in Python
+        # NOTE: project only the columns consumed below instead of
+        #       loading full ORM objects
+        query = session.query(Permission) \
+            .join(Permission.resource) \
+            .filter(Resource.type == resource_type) \
+            .filter(Permission.id.in_(user_permission_ids)) \
+            .order_by(Resource.id, Permission.priority.desc()) \
+            .distinct(Resource.id) \
+            .with_entities(
+                Resource.id, Resource.name, Resource.parent_id,
+                Permission.write
+            )
 
         # optional filters
         if name is not None:
@@ -49,15 +62,18 @@ class ResourcePermission(PermissionQuery):
             # filter by resource parent ID
             query = query.filter(Resource.parent_id == parent_id)
 
-        for permission in query.all():
-            resource = permission.resource
-            # NOTE: permissions sorted by priority, so permission with
-            #       higher priority will override lower priority
-            permissions[resource.id] = {
-                'id': resource.id,
-                'name': resource.name,
-                'parent_id': resource.parent_id,
-                'writable': permission.write
+        # stream rows in chunks with a server-side cursor instead of
+        # materializing the full result list
+        query = query.yield_per(500).execution_options(stream_results=True)
+
+        for row in query:
+            # NOTE: query returns one row per resource, with the
+            #       permission of the highest priority
+            permissions[row.id] = {
+                'id': row.id,
+                'name': row.name,
+                'parent_id': row.parent_id,
+                'writable': row.write
             }
 
         return permissions
@@ -80,7 +96,7 @@ class ResourcePermission(PermissionQuery):
         name = params.get('name')
         parent_id = params.get('parent_id')
 
-        Resource = self.config_models.model('resources')
+        Resource = self.Resource
 
         query = self.resource_restrictions_query(
             resource_type, username, group, session
@@ -98,7 +114,11 @@ class ResourcePermission(PermissionQuery):
             # filter by resource parent ID
             query = query.filter(Resource.parent_id == parent_id)
 
-        for resource in query.all():
+        # stream rows in chunks with a server-side cursor instead of
+        # materializing the full result list
+        query = query.yield_per(500).execution_options(stream_results=True)
+
+        for resource in query:
             restrictions[resource.id] = {
                 'id': resource.id,
                 'name': resource.name,
@@ -106,3 +126,27 @@ class ResourcePermission(PermissionQuery):
             }
 
         return restrictions
+
+    def permissions_and_restrictions(self, resource_type, params, username,
+                                     group, session):
+        """Query permitted and restricted resources for a resource type
+        in one transaction.
+
+        Return permitted and restricted resources.
+
+        :param str resource_type: Resource type
+        :param obj params: Optional request parameters with
+                           name=<name filter>&parent_id=<parent filter>
+        :param str username: User name
+        :param str group: Group name
+        :param Session session: DB session
+        """
+        # run both queries on the same session and connection
+        return {
+            'permissions': self.permissions(
+                resource_type, params, username, group, session
+            ),
+            'restrictions': self.restrictions(
+                resource_type, params, username, group, session
+            )
+        }
@@ -55,6 +55,26 @@ resource_restrictions_response = create_model(api, 'Resource restrictions', [
                                 )]
 ])
 
+resource_permissions_and_restrictions_response = create_model(
+    api, 'Resource permissions and restrictions', [
+        ['resource_type', fields.String(required=True,
+                                        description='Resource type',
+                                        example='map')],
+        ['permissions', fields.Raw(required=True,
+                                   description='Permitted resources',
+                                   example={'1': {'id': 1,
+                                            'name': 'qwc_demo',
+                                            'parent_id': None,
+                                            'writable': False}}
+                                   )],
+        ['restrictions', fields.Raw(required=True,
+                                    description='Restricted resources',
+                                    example={'2': {'id': 2,
+                                             'name': 'edit_points',
+                                             'parent_id': 1}}
+                                    )]
+    ])
+
 service_permissions_response = create_model(api, 'Service permissions', [
     ['service', fields.String(required=True, description='Service type',
                               example='ogc')],
@@ -68,7 +88,7 @@ service_permissions_response = create_model(api, 'Service permissions', [
 @api.route('/last_update')
 class LastUpdate(Resource):
     @api.doc('last_update')
-    @api.marshal_with(last_update_response)
+    @api.response(200, 'Success', last_update_response)
     def get(self):
         """Get timestamp of last permissions update"""
         return config_service.last_update()
@@ -76,7 +96,7 @@ class LastUpdate(Resource):
 @api.route('/cache_project_settings')
 class CacheProjectSettings(Resource):
     @api.doc('cache_project_settings')
-    @api.marshal_with(cache_project_settings_response)
+    @api.response(200, 'Success', cache_project_settings_response)
     def get(self):
         """Cache all known project settings"""
         return config_service.cache_project_settings()
@@ -90,25 +110,28 @@ class CacheProjectSettings(Resource):
 @api.param('parent_id', 'Parent resource ID filter (optional)')
 class Permissions(Resource):
     @api.doc('resource_permissions')
-    @api.marshal_with(resource_permissions_response)
+    @api.response(200, 'Success', resource_permissions_response)
     def get(self, resource_type):
         """Query permitted resources for a resource type
 
         <b>permissions</b> are empty if resource type is not available or \
         not permitted
         """
-        username = request.args.get('username', None)
-        group = request.args.get('group', None)
+        # resolve request args proxy once
+        args = request.args
+        username = args.get('username', None)
+        group = args.get('group', None)
         result = config_service.resource_permissions(
-            resource_type, request.args, username, group
+            resource_type, args, username, group
         )
-        if 'error' not in result:
+        error = result.get('error')
+        if error is None:
             return {
                 'resource_type': resource_type,
                 'permissions': result['permissions']
             }
         else:
-            api.abort(404, result['error'])
+            api.abort(404, error)
 
 
 @api.route('/restrictions/<resource_type>')
@@ -120,25 +143,62 @@ class Permissions(Resource):
 @api.param('parent_id', 'Parent resource ID filter (optional)')
 class Restrictions(Resource):
     @api.doc('resource_restrictions')
-    @api.marshal_with(resource_restrictions_response)
+    @api.response(200, 'Success', resource_restrictions_response)
     def get(self, resource_type):
         """Query restricted resources for a resource type
 
         <b>permissions</b> are empty if resource type is not available or \
         not restricted
         """
-        username = request.args.get('username', None)
-        group = request.args.get('group', None)
+        # resolve request args proxy once
+        args = request.args
+        username = args.get('username', None)
+        group = args.get('group', None)
         result = config_service.resource_restrictions(
-            resource_type, request.args, username, group
+            resource_type, args, username, group
+        )
+        error = result.get('error')
+        if error is None:
+            return {
+                'resource_type': resource_type,
+                'restrictions': result['restrictions']
+            }
+        else:
+            api.abort(404, error)
+
+
+@api.route('/permissions_and_restrictions/<resource_type>')
+@api.param('resource_type', 'Resource type (e.g. <i>map</i>, <i>layer</i>)',
+           default='map')
+@api.param('username', 'User name')
+@api.param('group', 'Group name')
+@api.param('name', 'Resource name filter (optional)')
+@api.param('parent_id', 'Parent resource ID filter (optional)')
+class PermissionsAndRestrictions(Resource):
+    @api.doc('resource_permissions_and_restrictions')
+    @api.response(200, 'Success', resource_permissions_and_restrictions_response)
+    def get(self, resource_type):
+        """Query permitted and restricted resources for a resource type
+
+        Combines <b>/permissions</b> and <b>/restrictions</b> in a \
+        single request and DB transaction
+        """
+        # resolve request args proxy once
+        args = request.args
+        username = args.get('username', None)
+        group = args.get('group', None)
+        result = config_service.resource_permissions_and_restrictions(
+            resource_type, args, username, group
         )
-        if 'error' not in result:
+        error = result.get('error')
+        if error is None:
             return {
                 'resource_type': resource_type,
+                'permissions': result['permissions'],
                 'restrictions': result['restrictions']
             }
         else:
-            api.abort(404, result['error'])
+            api.abort(404, error)
 
 
 @api.route('/<service>')
@@ -152,7 +212,7 @@ class Restrictions(Resource):
 @api.param('dataset', 'Dataset ID', default='qwc_demo.edit_points')
 class ServicePermissions(Resource):
     @api.doc('service_permissions')
-    @api.marshal_with(service_permissions_response)
+    @api.response(200, 'Success', service_permissions_response)
     def get(self, service):
         """Query permissions for a service
 
@@ -165,18 +225,21 @@ class ServicePermissions(Resource):
         * <b>ows_type</b>: OGC service
         * <b>dataset</b>: Data service
         """
-        username = request.args.get('username', None)
-        group = request.args.get('group', None)
+        # resolve request args proxy once
+        args = request.args
+        username = args.get('username', None)
+        group = args.get('group', None)
         result = config_service.service_permissions(
-            service, request.args, username, group
+            service, args, username, group
         )
-        if 'error' not in result:
+        error = result.get('error')
+        if error is None:
             return {
                 'service': service,
                 'permissions': result['permissions']
             }
         else:
-            api.abort(404, result['error'])
+            api.abort(404, error)
 
 
 # local webserver
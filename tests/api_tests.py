@@ -10,9 +10,11 @@ import server
 class ApiTestCase(unittest.TestCase):
     """Test case for server API"""
 
-    def setUp(self):
+    @classmethod
+    def setUpClass(cls):
+        # share one test client instead of rebuilding it per test
         server.app.testing = True
-        self.app = FlaskClient(server.app, Response)
+        cls.app = FlaskClient(server.app, Response)
 
     def get(self, url):
         """Send GET request and return status code and decoded JSON from
@@ -39,26 +41,26 @@ class ApiTestCase(unittest.TestCase):
         self.assertEqual(200, status_code, "Status code is not OK")
         self.check_data_permission('places', json_data)
         permissions = json_data['permissions']
-        self.assertIsInstance(permissions['dataset'], str,
-                              "dataset is not an string")
         self.assertEqual(['id', 'name', 'description', 'num', 'value', 'type',
                          'amount', 'validated', 'datetime'],
                          permissions['attributes'])
 
-        self.assertIsInstance(permissions['writable'], bool,
-                              "writable is not an boolean")
-        self.assertIsInstance(permissions['schema'], str,
-                              "schema is not an string")
-        self.assertIsInstance(permissions['table_name'], str,
-                              "table_name is not an string")
-        self.assertIsInstance(permissions['primary_key'], str,
-                              "primary_key is not an string")
-        self.assertIsInstance(permissions['geometry_column'], str,
-                              "geometry_column is not an string")
-        self.assertIsInstance(permissions['geometry_type'], str,
-                              "geometry_type is not an string")
-        self.assertIsInstance(permissions['srid'], int,
-                              "srid is not an integer")
+        expected_types = [
+            ('dataset', str, 'string'),
+            ('writable', bool, 'boolean'),
+            ('schema', str, 'string'),
+            ('table_name', str, 'string'),
+            ('primary_key', str, 'string'),
+            ('geometry_column', str, 'string'),
+            ('geometry_type', str, 'string'),
+            ('srid', int, 'integer')
+        ]
+        for key, expected_type, type_name in expected_types:
+            with self.subTest(key=key):
+                self.assertIsInstance(
+                    permissions[key], expected_type,
+                    "%s is not an %s" % (key, type_name)
+                )
 
     def test_data_service_permission_invalid_dataset(self):
         status_code, json_data = self.get('/data?dataset=test')
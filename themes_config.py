@@ -6,19 +6,34 @@
 # This source code is licensed under the BSD-style license found in the
 # LICENSE file in the root directory of this source tree.
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import functools
+import hashlib
 import os
-try:
-    from urllib.request import urlopen
-except:
-    from urllib2 import urlopen
+import shutil
+import threading
+import time
 try:
     from urllib.parse import quote, urljoin, urlsplit, urlunsplit
 except:
     from urllib import quote
     from urlparse import urljoin, urlsplit, urlunsplit
-from xml.etree import ElementTree
+try:
+    # use C-backed parser if available
+    from lxml import etree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
+try:
+    # use C-backed JSON if available
+    import orjson
+except ImportError:
+    orjson = None
 import traceback
 import re
 import uuid
@@ -29,11 +44,49 @@ from werkzeug.urls import url_parse
 # get internal QGIS server URL from ENV
 baseUrl = os.environ.get('QGIS_SERVER_URL', 'http://localhost/wms').rstrip('/') + '/'
 qwc2_path = os.environ.get("QWC2_PATH", "qwc2").rstrip("/")
+# QGIS server base path, parsed once
+serverBasePath = url_parse(baseUrl).path
+
+# persistent HTTP session with keep-alive connection pooling for
+# QGIS server requests, shared across worker threads; retry transient
+# failures of the idempotent GET requests
+http = requests.Session()
+httpAdapter = HTTPAdapter(
+    pool_connections=16, pool_maxsize=32,
+    max_retries=Retry(total=2, backoff_factor=0.2)
+)
+http.mount('http://', httpAdapter)
+http.mount('https://', httpAdapter)
+
+# LRU cache for genThemes results:
+#     {(<themesConfig>, <mtime>, <permissions digest>): <result>}
+genThemesCache = OrderedDict()
+genThemesCacheLock = threading.Lock()
+GEN_THEMES_CACHE_SIZE = 128
+
+# parse JSON from a file object with the C-backed parser if available
+def jsonLoad(fh):
+    if orjson is not None:
+        return orjson.loads(fh.read())
+    return json.load(fh)
+
+
+# list pre-rendered map thumbnails once instead of one stat per theme
+def listMapThumbs():
+    try:
+        return frozenset(os.listdir(qwc2_path + "/assets/img/mapthumbs/"))
+    except OSError:
+        return frozenset()
+
 
 # load thumbnail from file or GetMap
-def getThumbnail(configItem, resultItem, layers, crs, extent):
+def getThumbnail(configItem, resultItem, layers, crs, extent, mapThumbs=None):
     if "thumbnail" in configItem:
-        if os.path.exists(qwc2_path + "/assets/img/mapthumbs/" + configItem["thumbnail"]):
+        if mapThumbs is not None:
+            exists = configItem["thumbnail"] in mapThumbs
+        else:
+            exists = os.path.exists(qwc2_path + "/assets/img/mapthumbs/" + configItem["thumbnail"])
+        if exists:
             resultItem["thumbnail"] = "img/mapthumbs/" + configItem["thumbnail"]
             return
 
@@ -46,65 +99,81 @@ def getThumbnail(configItem, resultItem, layers, crs, extent):
     bboxcx = 0.5 * (extent[0] + extent[2])
     bboxcy = 0.5 * (extent[1] + extent[3])
     imgratio = 200. / 100.
-    if bboxw > bboxh:
-        bboxratio = bboxw / bboxh
-        if bboxratio > imgratio:
-            bboxh = bboxw / imgratio
-        else:
-            bboxw = bboxh * imgratio
-    else:
-        bboxw = bboxh * imgratio
+    # grow the extent to the image aspect ratio without branching on
+    # which side is larger
+    bboxw = max(bboxw, bboxh * imgratio)
+    bboxh = max(bboxh, bboxw / imgratio)
     adjustedExtent = [bboxcx - 0.5 * bboxw, bboxcy - 0.5 * bboxh,
                       bboxcx + 0.5 * bboxw, bboxcy + 0.5 * bboxh]
-    url += "&BBOX=" + (",".join(map(str, adjustedExtent)))
-    url += "&LAYERS=" + quote(",".join(layers).encode('utf-8'))
+    url += "&BBOX=" + (",".join("%.6f" % v for v in adjustedExtent))
+    url += "&LAYERS=" + quote(",".join(layers))
 
     try:
-        request = urlopen(url)
-        reply = request.read()
         basename = configItem["url"].rsplit("/")[-1] + ".png"
-        try:
-            os.makedirs(qwc2_path + "/assets/img/genmapthumbs/")
-        except Exception as e:
-            if not isinstance(e, FileExistsError): raise e
+        os.makedirs(qwc2_path + "/assets/img/genmapthumbs/", exist_ok=True)
         thumbnail = qwc2_path + "/assets/img/genmapthumbs/" + basename
-        with open(thumbnail, "wb") as fh:
-            fh.write(reply)
+        # stream response to disk instead of buffering it in memory;
+        # fail fast if QGIS server is unreachable, so a down server
+        # does not stall every theme for the full timeout
+        with http.get(url, stream=True, timeout=10) as response, \
+                open(thumbnail, "wb") as fh:
+            response.raise_for_status()
+            shutil.copyfileobj(response.raw, fh, length=64 * 1024)
         resultItem["thumbnail"] = "img/genmapthumbs/" + basename
     except Exception as e:
         print("ERROR generating thumbnail for WMS " + configItem["url"] + ":\n" + str(e))
         resultItem["thumbnail"] = "img/mapthumbs/default.jpg"
-        traceback.print_exc()
+        if os.environ.get("__QWC_CONFIG_SERVICE_DEBUG", "0") == "1":
+            # full stack traces only on demand, as formatting them for
+            # every failed thumbnail is costly when the server is down
+            traceback.print_exc()
+
+# cache for referenced edit configs:
+#     {<path>: (<mtime>, <config>)}
+editConfigCache = {}
+
 
 def getEditConfig(editConfig, themesConfig):
     if not editConfig:
         return None
-    elif os.path.isabs(editConfig) and os.path.exists(editConfig):
-        with open(editConfig, encoding='utf-8') as fh:
-            config = json.load(fh)
-        return config
+
+    # resolve path to edit config file
+    if os.path.isabs(editConfig) and os.path.exists(editConfig):
+        filename = editConfig
     else:
         dirname = os.path.dirname(themesConfig)
         if not dirname:
             dirname = "."
         filename = os.path.join(dirname, editConfig)
-        if os.path.exists(filename):
-            with open(filename, encoding='utf-8') as fh:
-                config = json.load(fh)
-            return config
-    return None
+        if not os.path.exists(filename):
+            return None
+
+    # reuse parsed config while the file is unchanged, as the same edit
+    # config may be referenced by many themes
+    mtime = os.path.getmtime(filename)
+    cached = editConfigCache.get(filename)
+    if cached is not None and cached[0] == mtime:
+        config = cached[1]
+    else:
+        with open(filename, encoding='utf-8') as fh:
+            config = jsonLoad(fh)
+        editConfigCache[filename] = (mtime, config)
+
+    # NOTE: return a copy, as callers may modify the result
+    return copy.deepcopy(config)
 
+@functools.lru_cache(maxsize=1024)
 def urlPath(url):
     parts = urlsplit(url)
     return urlunsplit(('', '', parts.path, parts.query, parts.fragment))
 
 
+@functools.lru_cache(maxsize=1024)
 def wmsName(url):
     # get WMS name as relative path to QGIS server base path
     wms_name = url_parse(url).path
-    server_base_path = url_parse(baseUrl).path
-    if wms_name.startswith(server_base_path):
-        wms_name = wms_name[len(server_base_path):]
+    if wms_name.startswith(serverBasePath):
+        wms_name = wms_name[len(serverBasePath):]
 
     return wms_name
 
@@ -112,18 +181,38 @@ def wmsName(url):
 def uniqueThemeId(theme_name, config):
     # generate unique theme id from theme name
     used_theme_ids = config.get('usedThemeIds', [])
-    if theme_name in used_theme_ids:
+    # set for O(1) membership tests alongside the ordered list
+    used_theme_ids_set = config.get('_usedThemeIdsSet')
+    if used_theme_ids_set is None:
+        used_theme_ids_set = set(used_theme_ids)
+        config['_usedThemeIdsSet'] = used_theme_ids_set
+    if theme_name in used_theme_ids_set:
         # add suffix to name
         suffix = 1
-        while "%s_%d" % (theme_name, suffix) in used_theme_ids:
+        while "%s_%d" % (theme_name, suffix) in used_theme_ids_set:
             suffix += 1
         theme_name = "%s_%d" % (theme_name, suffix)
     # else keep original name
 
     used_theme_ids.append(theme_name)
+    used_theme_ids_set.add(theme_name)
     return theme_name
 
 
+# index direct child elements of a node by local tag name,
+# keeping the first child per name
+def childElementIndex(node):
+    index = {}
+    for child in node:
+        tag = child.tag
+        if not isinstance(tag, str):
+            # skip comments and processing instructions
+            continue
+        # strip namespace
+        index.setdefault(tag.rsplit('}', 1)[-1], child)
+    return index
+
+
 def getChildElement(parent, path, ns):
     for part in path:
         nodes = parent.findall(part, ns)
@@ -152,32 +241,68 @@ def getAttributeNS(element, name, np, ns):
         return element.get(name)
 
 
-# recursively get layer tree
-def getLayerTree(layer, permissions, resultLayers, visibleLayers, printLayers, level, collapseBelowLevel, titleNameMap, featureReports, searchLayers, np, ns):
-    name = getChildElementValue(layer, [np['ns'] + "Name"], ns)
-    title = getChildElementValue(layer, [np['ns'] + "Title"], ns)
-    layers = layer.findall(np['ns'] + "Layer", ns)
-    treeName = getChildElementValue(layer, [np['ns'] + "TreeName"], ns)
-
-    # print("getLayerTree from root layer '%s' (devel %d) with permissions %s" % (name, level, permissions))
-    if permissions is not None and level > 1 and name not in permissions['public_layers']:
-        return  # omit layer
-
-    # skip print layers
-    for printLayer in printLayers:
-        if type(printLayer) is list:
-            for entry in printLayer:
-                if entry["name"] == name:
-                    return
-        elif printLayer == name:
-            return
-
-    layerEntry = {"name": name, "title": title}
+def getHrefAttribute(element, np):
+    # get xlink href attribute with the qualified name precomputed in
+    # np, instead of formatting it on every call
+    if element is None:
+        return ""
+    return element.get(np['hrefAttrQName'])
+
+
+# get layer tree
+def getLayerTree(layer, publicLayers, resultLayers, visibleLayers, printLayerNames, level, collapseBelowLevel, titleNameMap, featureReports, searchLayers, np, ns):
+    # iterative depth-first traversal with an explicit worklist instead
+    # of one Python frame per layer; a group pushes a finalize entry
+    # below its children, so it is appended only after all its sublayers
+    # were processed, as in the former recursive version
+    stack = [(layer, resultLayers, level)]
+    while stack:
+        item = stack.pop()
+        if item[0] is None:
+            # finalize group after its children were processed
+            _, parentLayers, layerEntry, treeName = item
+            if not layerEntry["sublayers"]:
+                # skip empty groups
+                continue
+            parentLayers.append(layerEntry)
+            titleNameMap[treeName] = layerEntry["name"]
+            continue
+
+        layer, parentLayers, level = item
+
+        # index direct children once instead of scanning per lookup
+        idx = childElementIndex(layer)
+        name = getElementValue(idx.get("Name"))
+        title = getElementValue(idx.get("Title"))
+        layers = layer.findall(np['layerTag'], ns)
+        treeName = getElementValue(idx.get("TreeName"))
+
+        if publicLayers is not None and level > 1 and name not in publicLayers:
+            continue  # omit layer
+
+        # skip print layers
+        if name in printLayerNames:
+            continue
+
+        layerEntry = {"name": name, "title": title}
+
+        if layers:
+            # group
+            layerEntry["mutuallyExclusive"] = layer.get("mutuallyExclusive") == "1"
+            layerEntry["sublayers"] = []
+            if layer.get("expanded") == "0":
+                layerEntry["expanded"] = False
+            else:
+                layerEntry["expanded"] = False if collapseBelowLevel >= 0 and level >= collapseBelowLevel else True
+            # finalize group below its children
+            stack.append((None, parentLayers, layerEntry, treeName))
+            for sublayer in reversed(layers):
+                stack.append((sublayer, layerEntry["sublayers"], level + 1))
+            continue
 
-    if not layers:
         if layer.get("geometryType") == "WKBNoGeometry" or layer.get("geometryType") == "NoGeometry":
             # skip layers without geometry
-            return
+            continue
 
         # layer
         layerEntry["visibility"] = layer.get("visible") == "1"
@@ -191,35 +316,32 @@ def getLayerTree(layer, permissions, resultLayers, visibleLayers, printLayers, l
         if name in searchLayers:
             layerEntry["searchterms"] = [searchLayers[name]]
 
-        try:
-            onlineResource = getChildElement(layer, [np['ns'] + "Attribution", np['ns'] + "OnlineResource"], ns)
-            layerEntry["attribution"] = {
-                "Title": getChildElementValue(layer, [np['ns'] + "Attribution", np['ns'] + "Title"], ns),
-                "OnlineResource": getAttributeNS(onlineResource, 'href', 'xlink', ns)
-            }
-        except:
-            pass
-        try:
-            layerEntry["abstract"] = getChildElementValue(layer, [np['ns'] + "Abstract"], ns)
-        except:
-            pass
-        try:
-            onlineResource = getChildElement(layer, [np['ns'] + "DataURL", np['ns'] + "OnlineResource"], ns)
-            layerEntry["dataUrl"] = onlineResource.get(np['xlink'] + "href", ns)
-        except:
-            pass
-        try:
-            onlineResource = getChildElement(layer, [np['ns'] + "MetadataURL", np['ns'] + "OnlineResource"], ns)
-            layerEntry["metadataUrl"] = onlineResource.get(np['xlink'] + "href", ns)
-        except:
-            pass
-        try:
+        # probe optional children with explicit None checks instead of
+        # try/except flow control
+        attributionEl = idx.get("Attribution")
+        attribution = childElementIndex(attributionEl) \
+            if attributionEl is not None else {}
+        layerEntry["attribution"] = {
+            "Title": getElementValue(attribution.get("Title")),
+            "OnlineResource": getHrefAttribute(attribution.get("OnlineResource"), np)
+        }
+        layerEntry["abstract"] = getElementValue(idx.get("Abstract"))
+        dataUrlEl = idx.get("DataURL")
+        if dataUrlEl is not None:
+            onlineResource = childElementIndex(dataUrlEl).get("OnlineResource")
+            if onlineResource is not None:
+                layerEntry["dataUrl"] = getHrefAttribute(onlineResource, np)
+        metadataUrlEl = idx.get("MetadataURL")
+        if metadataUrlEl is not None:
+            onlineResource = childElementIndex(metadataUrlEl).get("OnlineResource")
+            if onlineResource is not None:
+                layerEntry["metadataUrl"] = getHrefAttribute(onlineResource, np)
+        keywordList = idx.get("KeywordList")
+        if keywordList is not None:
             keywords = []
-            for keyword in getChildElement(layer, [np['ns'] + "KeywordList"], ns).findall(np['ns'] + "Keyword", ns):
+            for keyword in keywordList.findall(np['keywordTag'], ns):
                 keywords.append(getElementValue(keyword))
             layerEntry["keywords"] = ",".join(keywords)
-        except:
-            pass
 
         if layer.get("transparency"):
             layerEntry["opacity"] = 255 - int(float(layer.get("transparency")) / 100 * 255)
@@ -227,73 +349,110 @@ def getLayerTree(layer, permissions, resultLayers, visibleLayers, printLayers, l
             layerEntry["opacity"] = int(float(layer.get("opacity")) * 255)
         else:
             layerEntry["opacity"] = 255
-        minScale = getChildElementValue(layer, [np['ns'] + "MinScaleDenominator"], ns)
-        maxScale = getChildElementValue(layer, [np['ns'] + "MaxScaleDenominator"], ns)
+        minScale = getElementValue(idx.get("MinScaleDenominator"))
+        maxScale = getElementValue(idx.get("MaxScaleDenominator"))
         if minScale and maxScale:
             layerEntry["minScale"] = int(float(minScale))
             layerEntry["maxScale"] = int(float(maxScale))
         # use geographic bounding box, as default CRS may have inverted axis order with WMS 1.3.0
-        geoBBox = getChildElement(layer, [np['ns'] + "EX_GeographicBoundingBox"], ns)
-        if geoBBox:
+        geoBBox = idx.get("EX_GeographicBoundingBox")
+        if geoBBox is not None and len(geoBBox):
+            bboxIndex = childElementIndex(geoBBox)
             layerEntry["bbox"] = {
                 "crs": "EPSG:4326",
                 "bounds": [
-                    float(getChildElementValue(geoBBox, [np['ns'] + "westBoundLongitude"], ns)),
-                    float(getChildElementValue(geoBBox, [np['ns'] + "southBoundLatitude"], ns)),
-                    float(getChildElementValue(geoBBox, [np['ns'] + "eastBoundLongitude"], ns)),
-                    float(getChildElementValue(geoBBox, [np['ns'] + "northBoundLatitude"], ns))
+                    float(getElementValue(bboxIndex.get("westBoundLongitude"))),
+                    float(getElementValue(bboxIndex.get("southBoundLatitude"))),
+                    float(getElementValue(bboxIndex.get("eastBoundLongitude"))),
+                    float(getElementValue(bboxIndex.get("northBoundLatitude")))
                 ]
             }
         if name in featureReports:
             layerEntry["featureReport"] = featureReports[name]
-    else:
-        # group
-        layerEntry["mutuallyExclusive"] = layer.get("mutuallyExclusive") == "1"
-        layerEntry["sublayers"] = []
-        if layer.get("expanded") == "0":
-            layerEntry["expanded"] = False
-        else:
-            layerEntry["expanded"] = False if collapseBelowLevel >= 0 and level >= collapseBelowLevel else True
-        for sublayer in layers:
-            getLayerTree(sublayer, permissions, layerEntry["sublayers"], visibleLayers, printLayers, level + 1, collapseBelowLevel, titleNameMap, featureReports, searchLayers, np, ns)
 
-        if not layerEntry["sublayers"]:
-            # skip empty groups
-            return
+        parentLayers.append(layerEntry)
+        titleNameMap[treeName] = name
+
+# short-lived cache for themes config mtime:
+#     (<checked at>, <mtime>)
+# the freshness check runs once per project settings lookup
+themesConfigMTimeCache = (0, -1)
 
-    resultLayers.append(layerEntry)
-    titleNameMap[treeName] = name
 
 def themesConfigMTime():
+    global themesConfigMTimeCache
+    checked_at, mtime = themesConfigMTimeCache
+    now = time.monotonic()
+    if now - checked_at < 1.0:
+        return mtime
+
     qwc2_path = os.environ.get('QWC2_PATH', 'qwc2/')
     themes_config_path = os.environ.get(
         'QWC2_THEMES_CONFIG', os.path.join(qwc2_path, 'themesConfig.json')
     )
 
+    mtime = -1
     if os.path.isfile(themes_config_path):
-        return os.path.getmtime(themes_config_path)
-    return -1
+        mtime = os.path.getmtime(themes_config_path)
+    themesConfigMTimeCache = (now, mtime)
 
-# parse GetCapabilities for theme
-def getTheme(config, permissions, configItem, result, resultItem, project_settings_cache, themesConfig):
+    return mtime
+
+# optional on-disk cache for GetProjectSettings responses, surviving
+# process restarts; set to a directory path to enable
+projectSettingsDiskCacheDir = os.environ.get(
+    "__QWC_CONFIG_SERVICE_PROJECT_SETTINGS_DISK_CACHE_DIR", "")
 
-    project_permissions = permissions.get(wmsName(configItem["url"])) if permissions is not None else None
-    if not project_permissions:
-        # no WMS permissions
-        return
 
+def diskCachedProjectSettings(ows_url):
+    # read GetProjectSettings from the on-disk cache, if fresh
+    key = hashlib.sha1(ows_url.encode('utf-8')).hexdigest()
+    path = os.path.join(projectSettingsDiskCacheDir, key + ".xml")
+    try:
+        if os.path.getmtime(path) >= themesConfigMTime():
+            with open(path, "rb") as fh:
+                return fh.read()
+    except OSError:
+        pass
+    return None
+
+
+def storeDiskCachedProjectSettings(ows_url, document):
+    # store GetProjectSettings in the on-disk cache
+    key = hashlib.sha1(ows_url.encode('utf-8')).hexdigest()
+    path = os.path.join(projectSettingsDiskCacheDir, key + ".xml")
+    try:
+        os.makedirs(projectSettingsDiskCacheDir, exist_ok=True)
+        # write to a temp file and rename, so readers never see
+        # partial documents
+        tmp_path = path + ".tmp.%d" % os.getpid()
+        with open(tmp_path, "wb") as fh:
+            fh.write(document)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print("Could not cache project settings for %s:\n%s" % (ows_url, e))
+
+
+# fetch and parse GetProjectSettings for a WMS
+def fetchProjectSettings(ows_url, project_settings_cache):
     cache = os.environ.get("__QWC_CONFIG_SERVICE_PROJECT_SETTINGS_CACHE", "0") == "1"
-    ows_url = urljoin(baseUrl, configItem["url"])
 
     if cache and \
+        project_settings_cache is not None and \
         ows_url in project_settings_cache and \
         project_settings_cache[ows_url]["timestamp"] != -1 and \
         project_settings_cache[ows_url]["timestamp"] >= themesConfigMTime():
-        root = project_settings_cache[ows_url]["document"]
         print("getTheme: Using cached project settings for %s" % ows_url)
-    else:
+        return project_settings_cache[ows_url]["document"]
+
+    document = None
+    fetched = False
+    if projectSettingsDiskCacheDir:
+        document = diskCachedProjectSettings(ows_url)
+
+    if document is None:
         # get GetProjectSettings
-        response = requests.get(
+        response = http.get(
             ows_url,
             params={
                 'SERVICE': 'WMS',
@@ -308,21 +467,64 @@ def getTheme(config, permissions, configItem, result, resultItem, project_settin
             return None
 
         document = response.content
+        fetched = True
 
-        # parse GetProjectSettings XML
-        ElementTree.register_namespace('', 'http://www.opengis.net/wms')
-        ElementTree.register_namespace('qgs', 'http://www.qgis.org/wms')
-        ElementTree.register_namespace('sld', 'http://www.opengis.net/sld')
-        ElementTree.register_namespace(
-            'xlink', 'http://www.w3.org/1999/xlink'
-        )
-        root = ElementTree.fromstring(document)
+    # parse GetProjectSettings XML
+    # NOTE: no register_namespace calls needed, as the document is
+    #       only parsed and searched, never serialized
+    root = ElementTree.fromstring(document)
 
-        if cache:
-            self.project_settings_cache[ows_url] = {
-                "document": root,
-                "timestamp": self.themesConfigMTime()
-            }
+    if fetched and projectSettingsDiskCacheDir:
+        # only persist documents that parsed successfully
+        storeDiskCachedProjectSettings(ows_url, document)
+
+    if cache and project_settings_cache is not None:
+        project_settings_cache[ows_url] = {
+            "document": root,
+            "timestamp": themesConfigMTime()
+        }
+
+    return root
+
+
+# recursively collect theme URLs of a group and its sub groups
+def collectThemeUrls(configGroup, urls):
+    for item in configGroup.get("items", []):
+        if "url" in item:
+            urls.append(item["url"])
+    for group in configGroup.get("groups", []):
+        collectThemeUrls(group, urls)
+
+
+# optional configItem keys copied to the theme entry as-is
+themePassthroughKeys = (
+    "format", "tiled", "scales", "printScales", "printResolutions",
+    "printGrid", "pluginData", "themeInfoLinks", "backgroundLayers",
+    "additionalMouseCrs", "printLabelForSearchResult", "printLabelConfig",
+    "watermark", "skipEmptyFeatureAttributes", "config", "mapTips", "userMap"
+)
+
+
+# parse GetCapabilities for theme
+def getTheme(config, permissions, configItem, result, resultItem, project_settings_cache, themesConfig, fetchedSettings=None):
+
+    # parse theme URL once and reuse below
+    wms_name = wmsName(configItem["url"])
+
+    project_permissions = permissions.get(wms_name) if permissions is not None else None
+    if not project_permissions:
+        # no WMS permissions
+        return
+
+    ows_url = urljoin(baseUrl, configItem["url"])
+
+    if fetchedSettings is not None and ows_url in fetchedSettings:
+        # use prefetched project settings
+        root = fetchedSettings[ows_url]
+    else:
+        root = fetchProjectSettings(ows_url, project_settings_cache)
+    if root is None:
+        return None
 
     # use default namespace for XML search
     # namespace dict
@@ -349,24 +551,53 @@ def getTheme(config, permissions, configItem, result, resultItem, project_settin
             'xlink': ''
         }
 
-    topLayer = root.find('%sCapability/%sLayer' % (np['ns'], np['ns']), ns)
+    # precompute tag names used per layer, instead of rebuilding them
+    # on every getLayerTree call
+    np['layerTag'] = np['ns'] + "Layer"
+    np['keywordTag'] = np['ns'] + "Keyword"
+    np['hrefAttrQName'] = "{%s}href" % ns['xlink'] if ns else "href"
+
+    # look up Service, Capability and Request elements once and reuse
+    # them below, instead of re-walking from the document root
+    serviceEl = getChildElement(root, [np['ns'] + "Service"], ns)
+    capability = getChildElement(root, [np['ns'] + "Capability"], ns)
+    requestEl = getChildElement(capability, [np['ns'] + "Request"], ns)
+    getFeatureInfoEl = getChildElement(requestEl, [np['ns'] + "GetFeatureInfo"], ns)
+
+    topLayer = getChildElement(capability, [np['ns'] + "Layer"], ns)
+
+    def serviceValue(path):
+        # child element value below the Service element
+        if serviceEl is None:
+            return ""
+        return getChildElementValue(serviceEl, path, ns)
 
     # use name from config or fallback to WMS title
-    wmsTitle = configItem.get("title") or getChildElementValue(root, [np['ns'] + "Service", np['ns'] + "Title"], ns) or getChildElementValue(topLayer, [np['ns'] + "Title"], ns)
+    wmsTitle = configItem.get("title") or serviceValue([np['ns'] + "Title"]) or getChildElementValue(topLayer, [np['ns'] + "Title"], ns)
 
     # keywords
     keywords = []
-    keywordList = getChildElement(root, [np['ns'] + "Service", np['ns'] + "KeywordList"], ns)
+    keywordList = getChildElement(serviceEl, [np['ns'] + "KeywordList"], ns) \
+        if serviceEl is not None else None
     if keywordList:
-        for keyword in keywordList.findall("%sKeyword" % np['ns'], ns):
+        for keyword in keywordList.findall(np['keywordTag'], ns):
             value = getElementValue(keyword)
             if value != "infoMapAccessService":
                 keywords.append(value)
 
-    # collect WMS layers for printing
-    printLayers = []
+    # sets for O(1) membership tests on large projects
+    public_layers = set(project_permissions['public_layers'])
+    print_templates = set(project_permissions['print_templates'])
+
+    # collect WMS layer names used for printing
+    printLayerNames = set()
     if "backgroundLayers" in configItem:
-        printLayers = [entry["printLayer"] for entry in configItem["backgroundLayers"] if "printLayer" in entry]
+        for entry in configItem["backgroundLayers"]:
+            printLayer = entry.get("printLayer")
+            if type(printLayer) is list:
+                printLayerNames.update(e["name"] for e in printLayer)
+            elif printLayer is not None:
+                printLayerNames.add(printLayer)
 
     # layer tree and visible layers
     collapseLayerGroupsBelowLevel = -1
@@ -376,24 +607,25 @@ def getTheme(config, permissions, configItem, result, resultItem, project_settin
     layerTree = []
     visibleLayers = []
     titleNameMap = {}
-    featureReports = configItem["featureReport"] if "featureReport" in configItem else {}
+    featureReports = configItem.get("featureReport", {})
     searchLayers = {}
     if "searchProviders" in configItem:
         solr = [p for p in configItem["searchProviders"] if
                 "provider" in p and p["provider"] == "solr"]
         if len(solr) == 1:
             searchLayers = solr[0].get("layers", {})
-    getLayerTree(topLayer, project_permissions, layerTree, visibleLayers,
-                 printLayers, 1, collapseLayerGroupsBelowLevel, titleNameMap, featureReports, searchLayers, np, ns)
+    getLayerTree(topLayer, public_layers, layerTree, visibleLayers,
+                 printLayerNames, 1, collapseLayerGroupsBelowLevel, titleNameMap, featureReports, searchLayers, np, ns)
     visibleLayers.reverse()
 
     # print templates
     printTemplates = []
-    composerTemplates = getChildElement(root, [np['ns'] + "Capability", np['ns'] + "ComposerTemplates"], ns)
+    composerTemplates = getChildElement(capability, [np['ns'] + "ComposerTemplates"], ns)
     if composerTemplates:
+        printLabelBlacklist = set(configItem.get("printLabelBlacklist", ()))
         for composerTemplate in composerTemplates.findall("%sComposerTemplate" % np['ns'], ns):
             template_name = composerTemplate.get("name")
-            if template_name not in project_permissions['print_templates']:
+            if template_name not in print_templates:
                 # skip if print template is not permitted
                 continue
 
@@ -408,60 +640,76 @@ def getTheme(config, permissions, configItem, result, resultItem, project_settin
                     "height": float(composerMap.get("height"))
                 }
             composerLabels = composerTemplate.findall("%sComposerLabel" % np['ns'], ns)
-            labels = [composerLabel.get("name") for composerLabel in composerLabels]
-            if "printLabelBlacklist" in configItem:
-                labels = list(filter(lambda label: label not in configItem["printLabelBlacklist"], labels))
+            labels = [
+                composerLabel.get("name") for composerLabel in composerLabels
+                if composerLabel.get("name") not in printLabelBlacklist
+            ]
 
             if labels:
                 printTemplate["labels"] = labels
             printTemplates.append(printTemplate)
 
     # drawing order
-    drawingOrder = getChildElementValue(root, [np['ns'] + "Capability", np['ns'] + "LayerDrawingOrder"], ns).split(",")
-    drawingOrder = list(map(lambda title: titleNameMap[title] if title in titleNameMap else title, drawingOrder))
+    drawingOrder = getChildElementValue(capability, [np['ns'] + "LayerDrawingOrder"], ns).split(",")
+    drawingOrder = [titleNameMap.get(title, title) for title in drawingOrder]
     # filter by permissions
     drawingOrder = [
         title for title in drawingOrder
-        if title in project_permissions['public_layers']
+        if title in public_layers
     ]
 
     # getmap formats
     availableFormats = []
-    for format in getChildElement(root, [np['ns'] + "Capability", np['ns'] + "Request", np['ns'] + "GetMap"], ns).findall("%sFormat" % np['ns'], ns):
+    for format in getChildElement(requestEl, [np['ns'] + "GetMap"], ns).findall("%sFormat" % np['ns'], ns):
         availableFormats.append(getElementValue(format))
 
     # update theme config
     resultItem["url"] = urlPath(configItem["url"])
-    resultItem["id"] = uniqueThemeId(wmsName(configItem["url"]), config)
+    resultItem["id"] = uniqueThemeId(wms_name, config)
     resultItem["name"] = getChildElementValue(topLayer, [np['ns'] + "Name"], ns)
     resultItem["title"] = wmsTitle
-    resultItem["description"] = configItem["description"] if "description" in configItem else ""
+    resultItem["description"] = configItem.get("description", "")
     resultItem["attribution"] = {
         "Title": configItem["attribution"],
         "OnlineResource": configItem["attributionUrl"]
     }
-    resultItem["abstract"] = getChildElementValue(root, [np['ns'] + "Service", np['ns'] + "Abstract"], ns)
+    resultItem["abstract"] = serviceValue([np['ns'] + "Abstract"])
     resultItem["keywords"] = ", ".join(keywords)
-    resultItem["onlineResource"] = getAttributeNS(getChildElement(root, [np['ns'] + "Service", np['ns'] + "OnlineResource"], ns), 'href', 'xlink', ns)
+    resultItem["onlineResource"] = getHrefAttribute(
+        getChildElement(serviceEl, [np['ns'] + "OnlineResource"], ns)
+        if serviceEl is not None else None, np
+    )
+    # resolve the contact element chain once instead of re-walking it
+    # from the Service element for each field
+    contactEl = getChildElement(serviceEl, [np['ns'] + "ContactInformation"], ns) \
+        if serviceEl is not None else None
+    contactPersonEl = getChildElement(contactEl, [np['ns'] + "ContactPersonPrimary"], ns) \
+        if contactEl is not None else None
+
+    def contactValue(parent, tag):
+        if parent is None:
+            return ""
+        return getChildElementValue(parent, [np['ns'] + tag], ns)
+
     resultItem["contact"] = {
-        "person": getChildElementValue(root, [np['ns'] + "Service", np['ns'] + "ContactInformation", np['ns'] + "ContactPersonPrimary", np['ns'] + "ContactPerson"], ns),
-        "organization": getChildElementValue(root, [np['ns'] + "Service", np['ns'] + "ContactInformation", np['ns'] + "ContactPersonPrimary", np['ns'] + "ContactOrganization"], ns),
-        "position": getChildElementValue(root, [np['ns'] + "Service", np['ns'] + "ContactInformation", np['ns'] + "ContactPosition"], ns),
-        "phone": getChildElementValue(root, [np['ns'] + "Service", np['ns'] + "ContactInformation", np['ns'] + "ContactVoiceTelephone"], ns),
-        "email": getChildElementValue(root, [np['ns'] + "Service", np['ns'] + "ContactInformation", np['ns'] + "ContactElectronicMailAddress"], ns)
+        "person": contactValue(contactPersonEl, "ContactPerson"),
+        "organization": contactValue(contactPersonEl, "ContactOrganization"),
+        "position": contactValue(contactEl, "ContactPosition"),
+        "phone": contactValue(contactEl, "ContactVoiceTelephone"),
+        "email": contactValue(contactEl, "ContactElectronicMailAddress")
     }
 
-    resultItem["wms_name"] = wmsName(configItem["url"])
-    if "format" in configItem:
-        resultItem["format"] = configItem["format"]
+    resultItem["wms_name"] = wms_name
+    # copy optional configItem keys through in one pass
+    for key in themePassthroughKeys:
+        if key in configItem:
+            resultItem[key] = configItem[key]
     resultItem["availableFormats"] = availableFormats
-    if "tiled" in configItem:
-        resultItem["tiled"] = configItem["tiled"]
     if "version" in configItem:
         resultItem["version"] = configItem["version"]
     elif "defaultWMSVersion" in config:
         resultItem["version"] = config["defaultWMSVersion"]
-    resultItem["infoFormats"] = [getElementValue(format) for format in getChildElement(root, [np['ns'] + "Capability", np['ns'] + "Request", np['ns'] + "GetFeatureInfo"], ns).findall(np['ns'] + "Format", ns)]
+    resultItem["infoFormats"] = [getElementValue(format) for format in getFeatureInfoEl.findall(np['ns'] + "Format", ns)]
     # use geographic bounding box for theme, as default CRS may have inverted axis order with WMS 1.3.0
     bounds = [
         float(getChildElementValue(topLayer, [np['ns'] + "EX_GeographicBoundingBox", np['ns'] + "westBoundLongitude"], ns)),
@@ -475,19 +723,11 @@ def getTheme(config, permissions, configItem, result, resultItem, project_settin
     }
     if "extent" in configItem:
         resultItem["initialBbox"] = {
-            "crs": configItem["mapCrs"] if "mapCrs" in configItem else "EPSG:4326",
+            "crs": configItem.get("mapCrs", "EPSG:4326"),
             "bounds": configItem["extent"]
         }
     else:
         resultItem["initialBbox"] = resultItem["bbox"]
-    if "scales" in configItem:
-        resultItem["scales"] = configItem["scales"]
-    if "printScales" in configItem:
-        resultItem["printScales"] = configItem["printScales"]
-    if "printResolutions" in configItem:
-        resultItem["printResolutions"] = configItem["printResolutions"]
-    if "printGrid" in configItem:
-        resultItem["printGrid"] = configItem["printGrid"]
     # NOTE: skip root WMS layer
     resultItem["sublayers"] = layerTree[0]["sublayers"] if len(layerTree) > 0 and "sublayers" in layerTree[0] else []
     resultItem["expanded"] = True
@@ -497,23 +737,22 @@ def getTheme(config, permissions, configItem, result, resultItem, project_settin
         # filter by permissions
         resultItem["externalLayers"] = [
             externalLayer for externalLayer in configItem["externalLayers"]
-            if externalLayer.get('internalLayer')
-            in project_permissions['public_layers']
+            if externalLayer.get('internalLayer') in public_layers
         ]
+        # collect used external layer names while building the theme,
+        # instead of re-walking the whole result tree afterwards
+        used_external_layers = config.get('_usedExternalLayers')
+        if used_external_layers is not None:
+            used_external_layers.update(
+                externalLayer.get('name')
+                for externalLayer in resultItem["externalLayers"]
+            )
 
-    if "pluginData" in configItem:
-        resultItem["pluginData"] = configItem["pluginData"]
     if "minSearchScaleDenom" in configItem:
             resultItem["minSearchScaleDenom"] = configItem["minSearchScaleDenom"]
     elif "minSearchScale" in configItem: # Legacy name
         resultItem["minSearchScaleDenom"] = configItem["minSearchScale"]
-    if "themeInfoLinks" in configItem:
-            resultItem["themeInfoLinks"] = configItem["themeInfoLinks"]
-    if "backgroundLayers" in configItem:
-        resultItem["backgroundLayers"] = configItem["backgroundLayers"]
-    resultItem["searchProviders"] = configItem["searchProviders"] if "searchProviders" in configItem else []
-    if "additionalMouseCrs" in configItem:
-        resultItem["additionalMouseCrs"] = configItem["additionalMouseCrs"]
+    resultItem["searchProviders"] = configItem.get("searchProviders", [])
     if "mapCrs" in configItem:
         resultItem["mapCrs"] = configItem["mapCrs"]
     else:
@@ -521,30 +760,10 @@ def getTheme(config, permissions, configItem, result, resultItem, project_settin
     if printTemplates:
         resultItem["print"] = printTemplates
     resultItem["drawingOrder"] = drawingOrder
-    extraLegenParams = configItem["extraLegendParameters"] if "extraLegendParameters" in configItem else ""
-    resultItem["legendUrl"] = urlPath(getAttributeNS(getChildElement(root, [np['ns'] + "Capability", np['ns'] + "Request", np['sld'] + "GetLegendGraphic", np['ns'] + "DCPType", np['ns'] + "HTTP", np['ns'] + "Get", np['ns'] + "OnlineResource"], ns), 'href', 'xlink', ns) + extraLegenParams)
-    resultItem["featureInfoUrl"] = urlPath(getAttributeNS(getChildElement(root, [np['ns'] + "Capability", np['ns'] + "Request", np['ns'] + "GetFeatureInfo", np['ns'] + "DCPType", np['ns'] + "HTTP", np['ns'] + "Get", np['ns'] + "OnlineResource"], ns), 'href', 'xlink', ns))
-    resultItem["printUrl"] = urlPath(getAttributeNS(getChildElement(root, [np['ns'] + "Capability", np['ns'] + "Request", np['ns'] + "GetPrint", np['ns'] + "DCPType", np['ns'] + "HTTP", np['ns'] + "Get", np['ns'] + "OnlineResource"],  ns), 'href', 'xlink', ns))
-    if "printLabelForSearchResult" in configItem:
-        resultItem["printLabelForSearchResult"] = configItem["printLabelForSearchResult"]
-    if "printLabelConfig" in configItem:
-        resultItem["printLabelConfig"] = configItem["printLabelConfig"]
-
-    if "watermark" in configItem:
-        resultItem["watermark"] = configItem["watermark"]
-
-    if "skipEmptyFeatureAttributes" in configItem:
-        resultItem["skipEmptyFeatureAttributes"] = configItem["skipEmptyFeatureAttributes"]
-
-    if "config" in configItem:
-        resultItem["config"] = configItem["config"]
-
-    if "mapTips" in configItem:
-        resultItem["mapTips"] = configItem["mapTips"]
-
-    if "userMap" in configItem:
-        resultItem["userMap"] = configItem["userMap"]
-
+    extraLegenParams = configItem.get("extraLegendParameters", "")
+    resultItem["legendUrl"] = urlPath(getHrefAttribute(getChildElement(requestEl, [np['sld'] + "GetLegendGraphic", np['ns'] + "DCPType", np['ns'] + "HTTP", np['ns'] + "Get", np['ns'] + "OnlineResource"], ns), np) + extraLegenParams)
+    resultItem["featureInfoUrl"] = urlPath(getHrefAttribute(getChildElement(getFeatureInfoEl, [np['ns'] + "DCPType", np['ns'] + "HTTP", np['ns'] + "Get", np['ns'] + "OnlineResource"], ns), np))
+    resultItem["printUrl"] = urlPath(getHrefAttribute(getChildElement(requestEl, [np['ns'] + "GetPrint", np['ns'] + "DCPType", np['ns'] + "HTTP", np['ns'] + "Get", np['ns'] + "OnlineResource"],  ns), np))
     if project_permissions.get('edit_config'):
         # edit config from permissions
         resultItem["editConfig"] = project_permissions.get('edit_config')
@@ -557,19 +776,28 @@ def getTheme(config, permissions, configItem, result, resultItem, project_settin
                     resultItem["editConfig"][layer] = externalConfig[layer]
     else:
         # get edit config from referenced JSON
-        resultItem["editConfig"] = getEditConfig(configItem["editConfig"] if "editConfig" in configItem else None, themesConfig)
+        resultItem["editConfig"] = getEditConfig(configItem.get("editConfig", None), themesConfig)
 
     # set default theme
     if configItem.get('default', False) or not result["themes"]["defaultTheme"]:
         result["themes"]["defaultTheme"] = resultItem["id"]
 
-    # use first CRS for thumbnail request which is not CRS:84
-    for item in topLayer.findall(np['ns'] + "CRS", ns):
-        crs = getElementValue(item)
-        if crs != "CRS:84":
-            break
+    # use first CRS for thumbnail request which is not CRS:84, and
+    # collect bounding boxes, in a single pass over the children
+    crs = None
+    boundingBoxes = []
+    for child in topLayer:
+        tag = child.tag
+        if not isinstance(tag, str):
+            continue
+        tag = tag.rsplit('}', 1)[-1]
+        if tag == "CRS":
+            if crs is None or crs == "CRS:84":
+                crs = getElementValue(child)
+        elif tag == "BoundingBox":
+            boundingBoxes.append(child)
     extent = None
-    for bbox in topLayer.findall(np['ns'] + "BoundingBox", ns):
+    for bbox in boundingBoxes:
         if bbox.get("CRS") == crs:
             extent = [
                 float(bbox.get("minx")),
@@ -579,14 +807,22 @@ def getTheme(config, permissions, configItem, result, resultItem, project_settin
             ]
             break
     if extent:
-        getThumbnail(configItem, resultItem, visibleLayers, crs, extent)
+        thumbnail_tasks = config.get('_thumbnailTasks')
+        if thumbnail_tasks is not None:
+            # defer thumbnail generation, so genThemes can run the
+            # WMS GetMap requests of all themes concurrently
+            thumbnail_tasks.append(
+                (configItem, resultItem, visibleLayers, crs, extent)
+            )
+        else:
+            getThumbnail(configItem, resultItem, visibleLayers, crs, extent)
 
 
 # recursively get themes for groups
-def getGroupThemes(config, permissions, configGroup, result, resultGroup, project_settings_cache, groupCounter, themesConfig):
+def getGroupThemes(config, permissions, configGroup, result, resultGroup, project_settings_cache, groupCounter, themesConfig, fetchedSettings=None):
     for item in configGroup["items"]:
         itemEntry = {}
-        getTheme(config, permissions, item, result, itemEntry, project_settings_cache, themesConfig)
+        getTheme(config, permissions, item, result, itemEntry, project_settings_cache, themesConfig, fetchedSettings)
         if itemEntry:
             resultGroup["items"].append(itemEntry)
 
@@ -599,43 +835,56 @@ def getGroupThemes(config, permissions, configGroup, result, resultGroup, projec
                 "items": [],
                 "subdirs": []
             }
-            getGroupThemes(config, permissions, group, result, groupEntry, project_settings_cache, groupCounter, themesConfig)
+            getGroupThemes(config, permissions, group, result, groupEntry, project_settings_cache, groupCounter, themesConfig, fetchedSettings)
             resultGroup["subdirs"].append(groupEntry)
 
 
-def collectExternalLayers(itemsGroup):
-    """Recursively collect used external layer names.
-
-    :param obj itemsGroup: Theme items group (themes|subdirs)
-    """
-    external_layers = []
-    for item in itemsGroup["items"]:
-        for layer in item.get('externalLayers', []):
-            external_layers.append(layer.get('name'))
-
-    if "subdirs" in itemsGroup:
-        for group in itemsGroup["subdirs"]:
-            external_layers += collectExternalLayers(group)
-
-    return external_layers
-
-
 def reformatAttribution(entry):
     entry["attribution"] = {
-        "Title": entry["attribution"] if "attribution" in entry else None,
-        "OnlineResource": entry["attributionUrl"] if "attributionUrl" in entry else None
+        "Title": entry.get("attribution", None),
+        "OnlineResource": entry.get("attributionUrl", None)
     }
     entry.pop("attributionUrl", None)
     return entry
 
 
-def genThemes(themesConfig, permissions=None, project_settings_cache=None):
-    # load themesConfig.json
+def genThemes(themesConfig, permissions=None, project_settings_cache=None,
+              config=None):
+    # reuse cached result for unchanged themesConfig.json and identical
+    # effective permissions
     try:
-        with open(themesConfig, encoding='utf-8') as fh:
-            config = json.load(fh)
-    except:
-        return {"error": "Failed to read themesConfig.json"}
+        mtime = os.stat(themesConfig).st_mtime_ns
+    except OSError:
+        mtime = None
+
+    cacheKey = None
+    if mtime is not None:
+        if orjson is not None:
+            permissionsData = orjson.dumps(
+                permissions, default=str, option=orjson.OPT_SORT_KEYS
+            )
+        else:
+            permissionsData = json.dumps(
+                permissions, sort_keys=True, default=str
+            ).encode()
+        permissionsDigest = hashlib.blake2b(
+            permissionsData, digest_size=16
+        ).digest()
+        cacheKey = (themesConfig, mtime, permissionsDigest)
+        with genThemesCacheLock:
+            if cacheKey in genThemesCache:
+                genThemesCache.move_to_end(cacheKey)
+                # NOTE: return a copy, as callers may modify the result
+                return copy.deepcopy(genThemesCache[cacheKey])
+
+    # load themesConfig.json unless an already parsed config is passed in
+    # NOTE: config is modified below, so callers should pass a copy
+    if config is None:
+        try:
+            with open(themesConfig, encoding='utf-8') as fh:
+                config = jsonLoad(fh)
+        except:
+            return {"error": "Failed to read themesConfig.json"}
 
     result = {
         "themes": {
@@ -644,43 +893,96 @@ def genThemes(themesConfig, permissions=None, project_settings_cache=None):
             "items": [],
             "defaultTheme": None,
             "defaultScales": config["defaultScales"],
-            "defaultPrintScales": config["defaultPrintScales"] if "defaultPrintScales" in config else None,
-            "defaultPrintResolutions": config["defaultPrintResolutions"] if "defaultPrintResolutions" in config else None,
-            "defaultPrintGrid": config["defaultPrintGrid"] if "defaultPrintGrid" in config else None,
-            "pluginData": config["themes"]["pluginData"] if "pluginData" in config["themes"] else [],
-            "themeInfoLinks": config["themes"]["themeInfoLinks"] if "themeInfoLinks" in config["themes"] else [],
-            "externalLayers": config["themes"]["externalLayers"] if "externalLayers" in config["themes"] else [],
+            "defaultPrintScales": config.get("defaultPrintScales", None),
+            "defaultPrintResolutions": config.get("defaultPrintResolutions", None),
+            "defaultPrintGrid": config.get("defaultPrintGrid", None),
+            "pluginData": config["themes"].get("pluginData", []),
+            "themeInfoLinks": config["themes"].get("themeInfoLinks", []),
+            "externalLayers": config["themes"].get("externalLayers", []),
             "backgroundLayers": list(map(reformatAttribution, config["themes"]["backgroundLayers"])),
-            "defaultWMSVersion": config["defaultWMSVersion"] if "defaultWMSVersion" in config else None
+            "defaultWMSVersion": config.get("defaultWMSVersion", None)
             }
     }
 
     # store used theme ids
     config['usedThemeIds'] = []
+    config['_usedThemeIdsSet'] = set()
+    # collect deferred thumbnail requests from getTheme
+    config['_thumbnailTasks'] = []
+    # collect used external layer names from getTheme
+    config['_usedExternalLayers'] = set()
+
+    # prefetch project settings for all permitted themes concurrently,
+    # as each fetch blocks on QGIS server; theme processing itself stays
+    # sequential, so theme ids and the default theme are deterministic
+    themeUrls = []
+    collectThemeUrls(config["themes"], themeUrls)
+    if permissions is not None:
+        # skip themes without WMS permissions
+        themeUrls = [
+            url for url in themeUrls if permissions.get(wmsName(url))
+        ]
+    # unique service URLs, preserving order
+    owsUrls = list(dict.fromkeys(
+        urljoin(baseUrl, url) for url in themeUrls
+    ))
+
+    fetchedSettings = None
+    if len(owsUrls) > 1:
+        with ThreadPoolExecutor(max_workers=min(len(owsUrls), 8)) \
+                as executor:
+            roots = executor.map(
+                lambda ows_url: fetchProjectSettings(
+                    ows_url, project_settings_cache
+                ),
+                owsUrls
+            )
+            fetchedSettings = dict(zip(owsUrls, roots))
 
     groupCounter = 0
-    getGroupThemes(config, permissions, config["themes"], result, result["themes"], project_settings_cache, groupCounter, themesConfig)
+    getGroupThemes(config, permissions, config["themes"], result, result["themes"], project_settings_cache, groupCounter, themesConfig, fetchedSettings)
+
+    mapThumbs = listMapThumbs()
+
+    # generate theme thumbnails concurrently, as each WMS GetMap
+    # request blocks on QGIS server
+    thumbnailTasks = config.pop('_thumbnailTasks', [])
+    if len(thumbnailTasks) > 1:
+        with ThreadPoolExecutor(max_workers=min(len(thumbnailTasks), 8)) \
+                as executor:
+            for task in thumbnailTasks:
+                executor.submit(getThumbnail, *task, mapThumbs)
+    else:
+        for task in thumbnailTasks:
+            getThumbnail(*task, mapThumbs)
 
     if "backgroundLayers" in result["themes"]:
         # get thumbnails for background layers
         for backgroundLayer in result["themes"]["backgroundLayers"]:
-            imgPath = "img/mapthumbs/" + backgroundLayer.get("thumbnail", "default.jpg")
-            if not os.path.isfile(qwc2_path + "/assets/" + imgPath):
-                imgPath = "img/mapthumbs/default.jpg"
-            backgroundLayer["thumbnail"] = imgPath
+            thumbnail = backgroundLayer.get("thumbnail", "default.jpg")
+            if thumbnail not in mapThumbs:
+                thumbnail = "default.jpg"
+            backgroundLayer["thumbnail"] = "img/mapthumbs/" + thumbnail
 
-    if "externalLayers" in result["themes"]:
-        # collect used external layer names
-        external_layers = collectExternalLayers(result["themes"])
-        # unique external layer names
-        external_layers = set(external_layers)
+    # used external layer names, collected while building the themes
+    external_layers = config.pop('_usedExternalLayers', set())
 
+    if "externalLayers" in result["themes"]:
         # filter unused and restricted external layers
         result["themes"]["externalLayers"] = [
             layer for layer in result["themes"]["externalLayers"]
             if layer.get('name') in external_layers
         ]
 
+    if cacheKey is not None:
+        with genThemesCacheLock:
+            # NOTE: store a copy, as callers may modify the result
+            genThemesCache[cacheKey] = copy.deepcopy(result)
+            genThemesCache.move_to_end(cacheKey)
+            # evict oldest entries above cache size
+            while len(genThemesCache) > GEN_THEMES_CACHE_SIZE:
+                genThemesCache.popitem(last=False)
+
     return result
 
 
@@ -688,5 +990,12 @@ if __name__ == '__main__':
     print("Reading " + themesConfig)
     themes = genThemes(themesConfig, perm)
     # write config file
-    with open("./themes.json", "w") as fh:
-        json.dump(themes, fh, indent=2, separators=(',', ': '), sort_keys=True)
+    if orjson is not None:
+        with open("./themes.json", "wb") as fh:
+            fh.write(orjson.dumps(
+                themes, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS
+            ))
+    else:
+        with open("./themes.json", "w") as fh:
+            json.dump(themes, fh, indent=2, separators=(',', ': '),
+                      sort_keys=True)